@@ -0,0 +1,148 @@
+"""
+Run one of the parity checks of stingbee.parity on real data; exits with 1 when it fails.
+
+    python scripts/check_parity.py preprocess --image-folder scans/
+    python scripts/check_parity.py tokenizer --model-path ckpt --question-file questions.jsonl
+    python scripts/check_parity.py generation --model-path ckpt --image-folder scans/ --question-file questions.jsonl
+    python scripts/check_parity.py onnx --model-path ckpt --onnx-path vision.onnx --image-folder scans/
+"""
+import argparse
+import json
+import os
+import sys
+
+from PIL import Image
+
+from stingbee.parity import report
+
+
+def load_images(image_folder, num_images):
+    image_files = sorted(os.listdir(image_folder))[:num_images]
+    return [Image.open(os.path.join(image_folder, image_file)).convert('RGB') for image_file in image_files]
+
+
+def check_preprocess(args):
+    from transformers import CLIPImageProcessor
+    from stingbee.mm_utils import check_preprocess_parity
+
+    image_processor = CLIPImageProcessor.from_pretrained(args.vision_tower)
+    images = load_images(args.image_folder, args.num_images)
+    passed, stats = check_preprocess_parity(image_processor, images, size=args.size, pad_to_square=not args.no_pad,
+                                            max_abs_tol=args.max_abs_tol, mean_abs_tol=args.mean_abs_tol)
+    return report(f"Preprocessing parity with CLIPImageProcessor on {len(images)} images", passed, stats)
+
+
+def check_tokenizer(args):
+    from transformers import AutoTokenizer
+    from stingbee.tokenizer_parity import check_tokenizer_parity, PROBE_QUESTIONS, probe_prompts
+
+    slow_tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=False)
+    fast_tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=True)
+    # as in training for v1 templates
+    slow_tokenizer.pad_token = slow_tokenizer.unk_token
+    fast_tokenizer.pad_token = fast_tokenizer.unk_token
+
+    questions = list(PROBE_QUESTIONS)
+    for question_file in args.question_file:
+        with open(question_file, "r") as f:
+            for line in f:
+                question = json.loads(line)
+                questions.append(question.get("text", question.get("question")))
+    sources = []
+    for data_path in args.data_path:
+        with open(data_path, "r") as f:
+            sources.extend(sample["conversations"] for sample in json.load(f))
+
+    passed, stats = check_tokenizer_parity(slow_tokenizer, fast_tokenizer, questions=questions, prompts=probe_prompts(args.conv_mode),
+                                           sources=sources, conv_mode=args.conv_mode, max_examples=args.max_examples)
+    return report(f"Tokenizer parity on {len(questions)} questions and {len(sources)} training samples", passed, stats)
+
+
+def check_generation(args):
+    from stingbee.constants import DEFAULT_IMAGE_TOKEN
+    from stingbee.conversation import conv_templates
+    from stingbee.mm_utils import tokenizer_image_token, get_model_name_from_path
+    from stingbee.model.builder import load_pretrained_model
+    from stingbee.parity import check_batched_generation
+    from stingbee.utils import disable_torch_init
+
+    disable_torch_init()
+    model_name = get_model_name_from_path(os.path.expanduser(args.model_path))
+    tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name)
+
+    questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")][:args.num_questions]
+    prompts, images = [], []
+    for question in questions:
+        conv = conv_templates[args.conv_mode].copy()
+        conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + '\n' + question['text'])
+        conv.append_message(conv.roles[1], None)
+        prompts.append(tokenizer_image_token(conv.get_prompt(), tokenizer, return_tensors='pt').cuda())
+        image = Image.open(os.path.join(args.image_folder, question['image'])).convert('RGB')
+        images.append(image_processor.preprocess(image, crop_size={'height': 504, 'width': 504}, size={'shortest_edge': 504},
+                                                 return_tensors='pt')['pixel_values'].half().cuda())
+
+    passed, stats = check_batched_generation(model, tokenizer, prompts, images, batch_size=args.batch_size,
+                                             max_new_tokens=args.max_new_tokens, speculative=args.speculative)
+    return report(f"Batched {'speculative' if args.speculative else 'greedy'} output against batch size 1", passed, stats)
+
+
+def check_onnx(args):
+    from stingbee.mm_utils import get_model_name_from_path, process_images_demo
+    from stingbee.model.builder import load_pretrained_model
+    from stingbee.model.onnx_vision import OnnxVisionEncoder, check_onnx_parity
+
+    model_name = get_model_name_from_path(args.model_path)
+    tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, device_map='cpu', device='cpu',
+                                                                           truncate_vision_tower=True)
+    images = load_images(args.image_folder, args.num_images)
+    passed, stats = check_onnx_parity(model, OnnxVisionEncoder(args.onnx_path), process_images_demo(images, image_processor),
+                                      min_cosine=args.min_cosine)
+    return report(f"ONNX vision encoder parity on {len(images)} images", passed, stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    checks = parser.add_subparsers(dest="check", required=True)
+
+    preprocess = checks.add_parser("preprocess", help="BatchImageProcessor against PIL + CLIPImageProcessor.")
+    preprocess.add_argument("--vision-tower", type=str, default="openai/clip-vit-large-patch14")
+    preprocess.add_argument("--image-folder", type=str, required=True)
+    preprocess.add_argument("--num-images", type=int, default=64)
+    preprocess.add_argument("--size", type=int, default=504)
+    preprocess.add_argument("--no-pad", action="store_true")
+    preprocess.add_argument("--max-abs-tol", type=float, default=0.15)
+    preprocess.add_argument("--mean-abs-tol", type=float, default=0.01)
+    preprocess.set_defaults(run=check_preprocess)
+
+    tokenizer = checks.add_parser("tokenizer", help="Fast tokenizer against the slow one.")
+    tokenizer.add_argument("--model-path", type=str, required=True)
+    tokenizer.add_argument("--data-path", type=str, nargs="*", default=[], help="Instruct JSON files used for training.")
+    tokenizer.add_argument("--question-file", type=str, nargs="*", default=[], help="Question .jsonl files used for evaluation.")
+    tokenizer.add_argument("--conv-mode", type=str, default="llava_v1")
+    tokenizer.add_argument("--max-examples", type=int, default=5)
+    tokenizer.set_defaults(run=check_tokenizer)
+
+    generation = checks.add_parser("generation", help="Batched (or speculative) greedy answers against batch size 1.")
+    generation.add_argument("--model-path", type=str, required=True)
+    generation.add_argument("--model-base", type=str, default=None)
+    generation.add_argument("--image-folder", type=str, required=True)
+    generation.add_argument("--question-file", type=str, required=True)
+    generation.add_argument("--conv-mode", type=str, default="llava_v1")
+    generation.add_argument("--num-questions", type=int, default=64)
+    generation.add_argument("--batch-size", type=int, default=8)
+    generation.add_argument("--max-new-tokens", type=int, default=64)
+    generation.add_argument("--speculative", action="store_true", help="Compare speculative decoding against plain greedy generate.")
+    generation.set_defaults(run=check_generation)
+
+    onnx = checks.add_parser("onnx", help="An exported vision graph against the PyTorch tower and projector.")
+    onnx.add_argument("--model-path", type=str, required=True)
+    onnx.add_argument("--model-base", type=str, default=None)
+    onnx.add_argument("--onnx-path", type=str, required=True)
+    onnx.add_argument("--image-folder", type=str, required=True)
+    onnx.add_argument("--num-images", type=int, default=16)
+    onnx.add_argument("--min-cosine", type=float, default=0.99)
+    onnx.set_defaults(run=check_onnx)
+
+    args = parser.parse_args()
+
+    sys.exit(0 if args.run(args) else 1)
@@ -0,0 +1,40 @@
+import argparse
+import os
+
+from transformers import CLIPImageProcessor
+
+from stingbee.pixel_store import compile_pixel_store
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+def compile_images(args):
+    image_processor = CLIPImageProcessor.from_pretrained(args.vision_tower)
+    image_files = []
+    for root, _, files in os.walk(args.image_folder):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                image_files.append(os.path.relpath(os.path.join(root, file), args.image_folder))
+    image_files.sort()
+    print(f"Compiling {len(image_files)} images from {args.image_folder} into {args.output}")
+
+    compile_pixel_store(image_processor, args.image_folder, image_files, args.output, size=args.size,
+                        pad_to_square=not args.no_pad, shard_size=args.shard_size, num_workers=args.num_workers,
+                        min_size=args.size if args.jpeg_draft else None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vision-tower", type=str, default="openai/clip-vit-large-patch14")
+    parser.add_argument("--image-folder", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--size", type=int, default=504)
+    parser.add_argument("--no-pad", action="store_true", help="Resize the short side and center crop, as the batch eval scripts do, instead of padding to a square.")
+    parser.add_argument("--shard-size", type=int, default=1024)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--jpeg-draft", action="store_true")
+
+    args = parser.parse_args()
+
+    compile_images(args)
@@ -0,0 +1,45 @@
+import argparse
+import os
+
+from PIL import Image
+
+from stingbee.model.builder import load_pretrained_model
+from stingbee.model.onnx_vision import export_vision_onnx, quantize_vision_onnx, OnnxVisionEncoder, check_onnx_parity
+from stingbee.mm_utils import get_model_name_from_path, process_images_demo
+from stingbee.parity import report
+
+
+def export(args):
+    model_name = get_model_name_from_path(args.model_path)
+    tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, device_map='cpu', device='cpu',
+                                                                           truncate_vision_tower=True)
+
+    print(f"Exporting vision tower and projector to {args.output}")
+    export_vision_onnx(model, args.output, opset_version=args.opset)
+    onnx_path = args.output
+    if args.int8:
+        onnx_path = args.output.replace('.onnx', '') + '.int8.onnx'
+        print(f"Quantizing to {onnx_path}")
+        quantize_vision_onnx(args.output, onnx_path)
+
+    image_files = sorted(os.listdir(args.image_folder))[:args.num_images]
+    images = [Image.open(os.path.join(args.image_folder, image_file)).convert('RGB') for image_file in image_files]
+    passed, stats = check_onnx_parity(model, OnnxVisionEncoder(onnx_path), process_images_demo(images, image_processor),
+                                      min_cosine=args.min_cosine)
+    report(f"Parity with PyTorch on {len(images)} images", passed, stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--int8", action="store_true")
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    parser.add_argument("--image-folder", type=str, required=True, help="Eval scans to check the exported graph on.")
+    parser.add_argument("--num-images", type=int, default=16)
+
+    args = parser.parse_args()
+
+    export(args)
@@ -14,6 +14,10 @@ import torch
 import dataclasses
 from enum import auto, Enum
 from typing import List, Tuple, Any
+from collections import OrderedDict
+import uuid
+
+from stingbee.model.kv_cache import SessionCacheStore
 
 
 class SeparatorStyle(Enum):
@@ -38,6 +42,8 @@ class Conversation:
     version: str = "Unknown"
 
     skip_next: bool = False
+    # key of the chat session's KV cache in `Chat`; copies start a new session
+    session_id: str = None
 
     def get_prompt(self):
         messages = self.messages
@@ -389,12 +395,123 @@ conv_templates = {
     "mpt": conv_mpt,
 }
 
+class TemplateCompiler:
+    """Builds prompt token ids from cached segments instead of re-tokenizing the whole history.
+
+    Templates in the style of `llava_v1` (SeparatorStyle.TWO, `sep` a single space, `sep2` a
+    special token) are split at those separators. With a SentencePiece tokenizer, the pieces
+    on either side of such a split tokenize independently. The system prompt, the role
+    prefixes and every message seen so far are tokenized once and cached, so a new turn only
+    tokenizes its own text. Each template is checked once against
+    `tokenizer_image_token(conv.get_prompt())`. A template that fails the check, and any
+    conversation that cannot be split cleanly, falls back to full tokenization.
+    """
+
+    def __init__(self, tokenizer, max_segments=65536):
+        self.tokenizer = tokenizer
+        self.max_segments = max_segments
+        self.segments = OrderedDict()
+        self.verified = {}
+
+    def segment(self, text):
+        ids = self.segments.get(text)
+        if ids is not None:
+            self.segments.move_to_end(text)
+            return ids
+        ids = self.tokenizer(text).input_ids
+        if len(ids) > 0 and ids[0] == self.tokenizer.bos_token_id:
+            ids = ids[1:]
+        self.segments[text] = ids
+        if len(self.segments) > self.max_segments:
+            self.segments.popitem(last=False)
+        return ids
+
+    def supports(self, conv):
+        return conv.sep_style == SeparatorStyle.TWO and conv.sep == " " and 'mmtag' not in conv.version \
+            and conv.sep2 in self.tokenizer.all_special_tokens
+
+    @staticmethod
+    def splittable(text):
+        return len(text) > 0 and text[0] != " " and not text[-1].isspace()
+
+    def turn_ids(self, conv, i, role, message, last=True):
+        """Ids that turn `i` adds to the prompt, or None when it cannot be compiled."""
+        if type(message) is tuple:
+            if i != 0:
+                return None
+            message = "<image>\n" + message[0].replace("<image>", "").strip()
+        ids = []
+        if i == 0:
+            ids.append(self.tokenizer.bos_token_id)
+            if message and message.startswith(DEFAULT_IMAGE_TOKEN):
+                # `tokenizer_image_token` encodes everything before the image as one chunk
+                ids += self.segment(conv.system + conv.sep + role + ": ")
+                ids.append(IMAGE_TOKEN_INDEX)
+                message = message[len(DEFAULT_IMAGE_TOKEN):]
+            else:
+                if not self.splittable(conv.system):
+                    return None
+                ids += self.segment(conv.system) + self.segment(role + ":")
+        else:
+            ids += self.segment(role + ":")
+        if not message:
+            # an open slot for the reply, only valid at the end of the prompt
+            return ids if message is None and last else None
+        if not self.splittable(message) or DEFAULT_IMAGE_TOKEN in message or conv.sep2 in message:
+            return None
+        ids += self.segment(message)
+        if i % 2 == 1:
+            ids.append(self.tokenizer.convert_tokens_to_ids(conv.sep2))
+        return ids
+
+    def compile(self, conv):
+        """Prompt ids of `conv` assembled from segments, or None when it cannot be compiled."""
+        if not self.supports(conv) or not self.verify(conv):
+            return None
+        ids = []
+        for i, (role, message) in enumerate(conv.messages):
+            cur_ids = self.turn_ids(conv, i, role, message, last=i == len(conv.messages) - 1)
+            if cur_ids is None:
+                return None
+            ids += cur_ids
+        return ids
+
+    def verify(self, conv):
+        key = (conv.system, tuple(conv.roles), conv.sep, conv.sep2)
+        if key not in self.verified:
+            self.verified[key] = True
+            for first in [DEFAULT_IMAGE_TOKEN + "\nWhat is in this scan?", "What is in this scan?"]:
+                probe = conv.copy()
+                probe.messages = [[probe.roles[0], first], [probe.roles[1], "A knife is present."],
+                                  [probe.roles[0], "Where is it?"], [probe.roles[1], None]]
+                expected = tokenizer_image_token(probe.get_prompt(), self.tokenizer, IMAGE_TOKEN_INDEX)
+                if self.compile(probe) != expected:
+                    self.verified[key] = False
+                    break
+        return self.verified[key]
+
+    def prompt_ids(self, conv, return_tensors=None):
+        """Drop-in for `tokenizer_image_token(conv.get_prompt(), tokenizer, IMAGE_TOKEN_INDEX, return_tensors)`."""
+        ids = self.compile(conv)
+        if ids is None:
+            ids = tokenizer_image_token(conv.get_prompt(), self.tokenizer, IMAGE_TOKEN_INDEX)
+        if return_tensors == 'pt':
+            return torch.tensor(ids, dtype=torch.long)
+        if return_tensors is not None:
+            raise ValueError(f'Unsupported tensor type: {return_tensors}')
+        return ids
+
+
 class Chat:
-    def __init__(self, model, image_processor,tokenizer, device='cuda:0', stopping_criteria=None):
+    def __init__(self, model, image_processor,tokenizer, device='cuda:0', stopping_criteria=None, fast_preprocess=False, session_cache_bytes=0):
         self.device = device
         self.model = model
         self.vis_processor = image_processor
         self.tokenizer=tokenizer
+        self.fast_preprocess = fast_preprocess
+        self.template_compiler = TemplateCompiler(tokenizer)
+        # later turns only prefill the text after the last cached prompt
+        self.session_caches = SessionCacheStore(session_cache_bytes) if session_cache_bytes > 0 else None
 
         # if stopping_criteria is not None:
         #     self.stopping_criteria = stopping_criteria
@@ -413,9 +530,8 @@ class Chat:
     def answer_prepare(self, conv, img_list, max_new_tokens=300, num_beams=1, min_length=1, top_p=0.9,
                        repetition_penalty=1.05, length_penalty=1, temperature=1.0, max_length=2000):
         conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
-        # prompt='A chat between a curious human and an artificial intelligence assistant. The assistant gives helpful, detailed, and polite answers to the human\'s questions. USER: <image>\n hello ASSISTANT:'
-        text_input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(device=self.device)
+        # earlier turns come from the compiler's segment cache, only the new text is tokenized
+        text_input_ids = self.template_compiler.prompt_ids(conv, return_tensors='pt').unsqueeze(0).to(device=self.device)
 
         stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
         keywords = [stop_str]
@@ -441,8 +557,17 @@ class Chat:
             length_penalty=length_penalty,
             temperature=float(temperature),
         )
+        if self.session_caches is not None and begin_idx == 0:
+            if conv.session_id is None:
+                conv.session_id = uuid.uuid4().hex
+            generation_kwargs['session_id'] = conv.session_id
         return generation_kwargs
 
+    def reset_session(self, conv):
+        """Free the KV cache of the session, e.g. when the chat is cleared."""
+        if self.session_caches is not None and conv is not None and conv.session_id is not None:
+            self.session_caches.reset(conv.session_id)
+
     # def answer(self, conv, img_list, **kargs):
     #     generation_dict = self.answer_prepare(conv, img_list, **kargs)
     #     output_token = self.model_generate(**generation_dict)[0]
@@ -468,15 +593,20 @@ class Chat:
 
     def model_generate(self, *args, **kwargs):
         # for 8 bit and 16 bit compatibility
+        images = kwargs['kwargs']['images']
+        generate_kwargs = dict(do_sample=False,
+                               temperature=kwargs['kwargs']['temperature'],
+                               max_new_tokens=kwargs['kwargs']['max_new_tokens'],
+                               streamer=kwargs['kwargs']['streamer'],
+                               use_cache=kwargs['kwargs']['use_cache'],
+                               stopping_criteria=kwargs['kwargs']['stopping_criteria'])
         with torch.inference_mode():
-            output = self.model.generate(kwargs['kwargs']['input_ids'],
-                                         images=kwargs['kwargs']['images'],
-                                         do_sample=False,
-                                         temperature=kwargs['kwargs']['temperature'],
-                                         max_new_tokens=kwargs['kwargs']['max_new_tokens'],
-                                         streamer=kwargs['kwargs']['streamer'],
-                                         use_cache=kwargs['kwargs']['use_cache'],
-                                         stopping_criteria=kwargs['kwargs']['stopping_criteria'])
+            if kwargs['kwargs'].get('session_id') is not None:
+                # earlier turns and answers come from the session's cache, images included
+                output = self.session_caches.generate(kwargs['kwargs']['session_id'], self.model, kwargs['kwargs']['input_ids'],
+                                                      images, **generate_kwargs)
+            else:
+                output = self.model.generate(kwargs['kwargs']['input_ids'], images=images, **generate_kwargs)
             # import pdb;pdb.set_trace()
             # print(output)
             outputs = self.tokenizer.decode(output[0,kwargs['kwargs']['input_ids'].shape[1]:]).strip()
@@ -490,12 +620,12 @@ class Chat:
         img_list.pop(0)
         if isinstance(image, str):  # is a image path
             raw_image = Image.open(image).convert('RGB')
-            image = process_images_demo([raw_image], self.vis_processor)
+            image = process_images_demo([raw_image], self.vis_processor, fast=self.fast_preprocess, model_cfg=self.model.config)
             # print("raw")
             # image = self.vis_processor(raw_image).unsqueeze(0).to(self.device)
         elif isinstance(image, Image.Image):
             raw_image = image
-            image = process_images_demo([raw_image], self.vis_processor )
+            image = process_images_demo([raw_image], self.vis_processor, fast=self.fast_preprocess, model_cfg=self.model.config)
             image=image.to(device=self.device,dtype=torch.float16)
             # print("Image")
             # image = self.vis_processor(raw_image).unsqueeze(0).to(self.device)
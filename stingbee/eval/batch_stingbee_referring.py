@@ -5,13 +5,15 @@ import json
 from tqdm import tqdm
 import shortuuid
 
-from stingbee.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 from stingbee.conversation import conv_templates, SeparatorStyle
 from stingbee.model.builder import load_pretrained_model
 from stingbee.utils import disable_torch_init
-from stingbee.mm_utils import tokenizer_image_token, get_model_name_from_path, KeywordsStoppingCriteria
+from stingbee.mm_utils import get_model_name_from_path, KeywordsStoppingCriteria, FinishedRowsLogitsProcessor
+from stingbee.eval.pipeline import PrefetchPipeline, EvalBatchLoader
+from stingbee.model.kv_cache import generate_with_shared_prefix
+from stingbee.model.speculative import generate_speculative
 
-from PIL import Image
+from transformers import AutoModelForCausalLM
 import math
 def split_list(lst, n):
     """Split a list into n (roughly) equal-sized chunks"""
@@ -25,70 +27,86 @@ def get_chunk(lst, n, k):
 
 
 def eval_model(args):
+    # one decoding mode per run; reject combinations before loading anything
+    if args.share_image_prefix and args.speculative:
+        raise ValueError("--share-image-prefix cannot be combined with --speculative.")
+    if args.draft_model_path is not None and not args.speculative:
+        raise ValueError("--draft-model-path requires --speculative.")
     # Model
     disable_torch_init()
     model_path = os.path.expanduser(args.model_path)
     model_name = get_model_name_from_path(model_path)
-    tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name)
     # print(model)
     questions=[]
     questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
 
         
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
+    tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, token_budget=args.token_budget, truncate_vision_tower=args.truncate_vision_tower,
+                                                                           embedding_cache_bytes=int(args.embedding_cache_gb * (1 << 30)), embedding_cache_dir=args.embedding_cache_dir,
+                                                                           embedding_cache_disk_bytes=int(args.embedding_cache_disk_gb * (1 << 30)),
+                                                                           patch_drop_threshold=args.patch_drop_threshold, image_grid_token_budget=args.image_grid_token_budget,
+                                                                           use_fast_tokenizer=args.fast_tokenizer, tokenizer_parity_questions=[q['question'] for q in questions])
+    draft_model = None
+    if args.draft_model_path is not None:
+        draft_model = AutoModelForCausalLM.from_pretrained(args.draft_model_path, torch_dtype=torch.float16).cuda()
+    if args.image_grid_token_budget is not None and (args.pixel_store is not None):
+        raise ValueError("--image-grid-token-budget cannot be combined with --pixel-store.")
     answers_file = os.path.expanduser(args.answers_file)
     os.makedirs(os.path.dirname(answers_file), exist_ok=True)
     
     ans_file = open(answers_file, "w")
     
-    for i in tqdm(range(0,len(questions),args.batch_size)):
-        input_batch=[]
-        input_image_batch=[]
-        count=i
-        image_folder=[]     
-        batch_end = min(i + args.batch_size, len(questions))
-
-             
-        for j in range(i,batch_end):
-            image_file=questions[j]['image_id']+'.png'
-            qs="[identify] What is the object present at " + questions[j]['question']
-            
-            if model.config.mm_use_im_start_end:
-                qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + qs
-            else:
-                qs = DEFAULT_IMAGE_TOKEN + '\n' + qs
-
-            conv = conv_templates[args.conv_mode].copy()
-            conv.append_message(conv.roles[0], qs)
-            conv.append_message(conv.roles[1], None)
-            prompt = conv.get_prompt()
-
-            input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
-            input_batch.append(input_ids)
-
-            image = Image.open(os.path.join(args.image_folder, image_file))
-
-            image_folder.append(image)
-
-            stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-            keywords = [stop_str]
-            stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
-
-        max_length = max(tensor.size(1) for tensor in input_batch)
-
-        final_input_list = [torch.cat((torch.zeros((1,max_length - tensor.size(1)), dtype=tensor.dtype,device=tensor.get_device()), tensor),dim=1) for tensor in input_batch]
-        final_input_tensors=torch.cat(final_input_list,dim=0)
-        image_tensor_batch = image_processor.preprocess(image_folder,crop_size ={'height': 504, 'width': 504},size = {'shortest_edge': 504}, return_tensors='pt')['pixel_values']
-
-        with torch.inference_mode():
-            output_ids = model.generate( final_input_tensors, images=image_tensor_batch.half().cuda(), do_sample=False , temperature=args.temperature, top_p=args.top_p, num_beams=1, max_new_tokens=256,length_penalty=2.0, use_cache=True)
+    conv = conv_templates[args.conv_mode]
+    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+    if args.share_image_prefix:
+        # questions on the same image become neighbours and share one prefill
+        questions = sorted(questions, key=lambda q: q['image_id'])
+    # decode ahead of the batch loop; questions are consumed in order
+    batch_loader = EvalBatchLoader(model, tokenizer, image_processor, [q['image_id'] + '.png' for q in questions], args.conv_mode, image_folder=args.image_folder,
+                                   image_size=504, fast_preprocess=args.fast_preprocess, pixel_store=args.pixel_store,
+                                   decode_workers=args.decode_workers, jpeg_draft=args.jpeg_draft, share_image_prefix=args.share_image_prefix)
+    pad_token_id = batch_loader.pad_token_id
+
+    def load_batch(i):
+        return batch_loader.load(i, ["[identify] What is the object present at " + q['question'] for q in questions[i:i + args.batch_size]])
+
+    batch_starts = list(range(0,len(questions),args.batch_size))
+    if args.pipeline:
+        # load, preprocess and encode batch N+1 while batch N decodes
+        batches = PrefetchPipeline(batch_starts, load_batch, encode_fn=model.encode_images)
+    else:
+        batches = map(load_batch, batch_starts)
+
+    for batch in tqdm(batches, total=len(batch_starts)):
+        count = batch['start']
+        final_input_tensors = batch['input_ids']
+        # rows that emit the stop string are frozen instead of running to max_new_tokens
+        stopping_criteria = KeywordsStoppingCriteria([stop_str], tokenizer, final_input_tensors)
+        stop_kwargs = dict(stopping_criteria=[stopping_criteria], logits_processor=[FinishedRowsLogitsProcessor(stopping_criteria, tokenizer.eos_token_id)])
+        if 'image_features' in batch:
+            image_inputs = {'image_features': batch['image_features']}
+        else:
+            image_inputs = {'images': batch['images']}
+
+        if args.share_image_prefix:
+            output_ids = generate_with_shared_prefix(model, final_input_tensors, batch['attention_mask'], batch['group_sizes'], **image_inputs, max_new_tokens=256,
+                                                     pad_token_id=pad_token_id, eos_token_id=tokenizer.eos_token_id, **stop_kwargs)
+        elif args.speculative:
+            # greedy answers, several tokens per forward pass
+            output_ids = generate_speculative(model, final_input_tensors, batch['attention_mask'], **image_inputs, max_new_tokens=256,
+                                              num_draft_tokens=args.num_draft_tokens, max_ngram_size=args.max_ngram_size, draft_model=draft_model,
+                                              pad_token_id=pad_token_id, eos_token_id=tokenizer.eos_token_id, **stop_kwargs)
+        else:
+            with torch.inference_mode():
+                output_ids = model.generate( final_input_tensors, **image_inputs, attention_mask=batch['attention_mask'], pad_token_id=pad_token_id, do_sample=False , temperature=args.temperature, top_p=args.top_p, num_beams=1, max_new_tokens=256,length_penalty=2.0, use_cache=True, **stop_kwargs)
 
         input_token_len = final_input_tensors.shape[1]
         n_diff_input_output = (final_input_tensors != output_ids[:, :input_token_len]).sum().item()
         if n_diff_input_output > 0:
             print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
         outputs = tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)
-        for k in range(0,len(final_input_list)):
+        for k in range(0,len(outputs)):
             output = outputs[k].strip()
             if output.endswith(stop_str):
                 output = output[:-len(stop_str)]
@@ -111,6 +129,11 @@ def eval_model(args):
             count=count+1
             ans_file.flush()
     ans_file.close()
+    batch_loader.close()
+    if getattr(model, 'image_embedding_cache', None) is not None:
+        print(f"Image embedding cache: {model.image_embedding_cache.stats()}")
+    if args.patch_drop_threshold is not None:
+        print(f"Background patches dropped: {model.get_vision_tower().patch_drop_stats}")
 
 
 if __name__ == "__main__":
@@ -127,6 +150,24 @@ if __name__ == "__main__":
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
     parser.add_argument("--batch_size",type=int, default=1)
+    parser.add_argument("--token-budget", type=int, default=None, help="Merge visual tokens down to this many per image (e.g. 576, 324, 144).")
+    parser.add_argument("--truncate-vision-tower", action="store_true", help="Only build the vision tower up to mm_vision_select_layer.")
+    parser.add_argument("--embedding-cache-gb", type=float, default=0, help="In-memory budget of the image embedding cache (0 disables it).")
+    parser.add_argument("--embedding-cache-dir", type=str, default=None, help="Spill evicted image embeddings to this directory.")
+    parser.add_argument("--embedding-cache-disk-gb", type=float, default=10, help="Most disk space the spilled image embeddings take; the oldest are deleted.")
+    parser.add_argument("--patch-drop-threshold", type=float, default=None, help="Drop image patches whose pixel std is below this (e.g. 0.01).")
+    parser.add_argument("--pipeline", action="store_true", help="Load, preprocess and encode the next batch on a background thread while the current batch decodes.")
+    parser.add_argument("--image-grid-token-budget", type=int, default=None, help="Grid mode: keep the aspect ratio of each scan with at most this many visual tokens.")
+    parser.add_argument("--fast-preprocess", action="store_true", help="Preprocess images with the batched torch engine instead of CLIPImageProcessor.")
+    parser.add_argument("--decode-workers", type=int, default=0, help="Decode images on this many background processes.")
+    parser.add_argument("--jpeg-draft", action="store_true", help="Decode JPEGs at the smallest DCT scale that keeps the short side at least 504px.")
+    parser.add_argument("--pixel-store", type=str, default=None, help="Read images from a store compiled with scripts/compile_pixel_store.py --no-pad.")
+    parser.add_argument("--fast-tokenizer", action="store_true", help="Use the fast tokenizer if it matches the slow one on every question.")
+    parser.add_argument("--share-image-prefix", action="store_true", help="Group questions by image and prefill the system prompt and image once per image.")
+    parser.add_argument("--speculative", action="store_true", help="Greedy decoding that drafts tokens from n-gram matches in the prompt and answer and verifies them in one pass.")
+    parser.add_argument("--num-draft-tokens", type=int, default=8, help="Tokens drafted per speculative step.")
+    parser.add_argument("--max-ngram-size", type=int, default=3, help="Longest answer tail looked up for a draft.")
+    parser.add_argument("--draft-model-path", type=str, default=None, help="Small causal LM with the same tokenizer to draft from when no n-gram matches (with --speculative).")
     args = parser.parse_args()
 
     eval_model(args)
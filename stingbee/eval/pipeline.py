@@ -0,0 +1,158 @@
+import itertools
+import os
+import queue
+import threading
+
+import torch
+
+from stingbee.constants import DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+from stingbee.conversation import conv_templates, TemplateCompiler
+from stingbee.image_loader import ImageLoader
+from stingbee.mm_utils import process_images, BatchImageProcessor, left_pad_input_ids
+from stingbee.pixel_store import PixelStore
+
+
+_END = object()
+
+
+class PrefetchPipeline:
+    """Prepare batch N+1 on a producer thread while the caller decodes batch N.
+
+    `prepare_fn(item)` loads and preprocesses one batch and returns a dict. When
+    `encode_fn` is given, the producer also runs it on `batch['images']` (on its own
+    CUDA stream when available) and stores the result as `batch['image_features']`,
+    so generation can start from precomputed image features.
+    """
+
+    def __init__(self, items, prepare_fn, encode_fn=None, depth=1):
+        self.items = items
+        self.prepare_fn = prepare_fn
+        self.encode_fn = encode_fn
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+
+    def _produce(self):
+        stream = torch.cuda.Stream() if torch.cuda.is_available() and self.encode_fn is not None else None
+        try:
+            with torch.inference_mode():
+                for item in self.items:
+                    if self.stop_event.is_set():
+                        return
+                    batch = self.prepare_fn(item)
+                    if self.encode_fn is not None:
+                        if stream is not None:
+                            with torch.cuda.stream(stream):
+                                batch['image_features'] = self.encode_fn(batch['images'])
+                            stream.synchronize()
+                        else:
+                            batch['image_features'] = self.encode_fn(batch['images'])
+                    self.queue.put(batch)
+        except Exception as e:
+            self.queue.put(e)
+            return
+        self.queue.put(_END)
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is _END:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            self.stop_event.set()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class EvalBatchLoader:
+    """Build the batches of an eval script from question texts and image files.
+
+    Images are decoded ahead on an `ImageLoader` (or read from a pixel store, which
+    holds them decoded and resized to 504px so only normalization is left) and are
+    consumed in question order, so `load` must be called with increasing starts. With
+    `share_image_prefix`, consecutive questions on the same image file read it once
+    and are counted in `group_sizes`; callers sort the questions by image first.
+
+    Args:
+        image_files (List[str]): Image file of each question, relative to `image_folder`
+            or keys of the pixel store.
+        image_size (int): Side of the center crop fed to the vision tower; ignored in
+            grid mode, where each scan is resized to its token budget instead.
+    """
+
+    def __init__(self, model, tokenizer, image_processor, image_files, conv_mode, image_folder='', image_size=504,
+                 fast_preprocess=False, pixel_store=None, decode_workers=0, jpeg_draft=False, share_image_prefix=False):
+        self.model = model
+        self.image_processor = image_processor
+        self.image_files = image_files
+        self.conv_mode = conv_mode
+        self.image_size = image_size
+        self.share_image_prefix = share_image_prefix
+        # the system prompt and role prefixes are tokenized once
+        self.template_compiler = TemplateCompiler(tokenizer)
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.unk_token_id
+        self.fast_processor = BatchImageProcessor.from_image_processor(image_processor, size=image_size, pad_to_square=False) if fast_preprocess else None
+        self.image_loader = ImageLoader(decode_workers, min_size=504 if jpeg_draft else None)
+        stream_files = [image_file for image_file, _ in itertools.groupby(image_files)] if share_image_prefix else image_files
+        if pixel_store is not None:
+            pixel_store = PixelStore(pixel_store)
+            pixel_store.check_mode(504, False)
+            self.image_stream = map(pixel_store.get, stream_files)
+            self.fast_processor = BatchImageProcessor.from_image_processor(image_processor, size=image_size, pad_to_square=False)
+        else:
+            self.image_stream = self.image_loader.imap([os.path.join(image_folder, image_file) for image_file in stream_files])
+        self.image = None
+
+    def prompt_ids(self, question):
+        """Tokenize one question behind the image token, as the user turn of `conv_mode`."""
+        if self.model.config.mm_use_im_start_end:
+            question = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + question
+        else:
+            question = DEFAULT_IMAGE_TOKEN + '\n' + question
+        conv = conv_templates[self.conv_mode].copy()
+        conv.append_message(conv.roles[0], question)
+        conv.append_message(conv.roles[1], None)
+        return self.template_compiler.prompt_ids(conv, return_tensors='pt').cuda()
+
+    def preprocess(self, images):
+        if getattr(self.model.config, 'image_aspect_ratio', None) == 'grid':
+            # resized to the token budget at the scan's aspect ratio; sizes differ, so this may be a list
+            image_tensor = process_images(images, self.image_processor, self.model.config)
+        elif self.fast_processor is not None:
+            image_tensor = self.fast_processor(images)
+        else:
+            image_tensor = self.image_processor.preprocess(images, crop_size={'height': self.image_size, 'width': self.image_size},
+                                                           size={'shortest_edge': self.image_size}, return_tensors='pt')['pixel_values']
+        if isinstance(image_tensor, list):
+            return [image.half().cuda() for image in image_tensor]
+        return image_tensor.half().cuda()
+
+    def load(self, start, questions):
+        """Batch the questions starting at row `start` with their images.
+
+        Returns:
+            dict: `input_ids` and `attention_mask` padded on the left, so batched answers
+            match batch size 1, the decoded `pil_images` (one per group), their `images`
+            on the GPU, and the `group_sizes` of the questions sharing each image.
+        """
+        images, group_sizes = [], []
+        for j in range(start, start + len(questions)):
+            new_image = not self.share_image_prefix or j == 0 or self.image_files[j] != self.image_files[j - 1]
+            if new_image:
+                self.image = next(self.image_stream)
+            if new_image or j == start:
+                images.append(self.image)
+                group_sizes.append(0)
+            group_sizes[-1] += 1
+        input_ids, attention_mask = left_pad_input_ids([self.prompt_ids(question) for question in questions], self.pad_token_id)
+        return {'start': start, 'input_ids': input_ids, 'attention_mask': attention_mask, 'group_sizes': group_sizes,
+                'pil_images': images, 'images': self.preprocess(images)}
+
+    def close(self):
+        self.image_loader.close()
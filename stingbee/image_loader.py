@@ -0,0 +1,69 @@
+import collections
+import functools
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+
+def open_image(image_file, min_size=None):
+    """Decode an image as RGB.
+
+    With `min_size`, JPEGs are decoded with PIL's draft mode: the DCT is scaled down by
+    the largest power of two (up to 8) that still leaves the short side at least
+    `min_size` pixels, so a large scan is never decoded at full size only to be shrunk
+    to 504px afterwards. Other formats are decoded normally.
+    """
+    image = Image.open(image_file)
+    if min_size and image.format == 'JPEG':
+        width, height = image.size
+        scale = min(width, height) / min_size
+        if scale >= 2:
+            image.draft('RGB', (math.ceil(width / scale), math.ceil(height / scale)))
+    return image.convert('RGB')
+
+
+class ImageLoader:
+    """Decodes images on a process pool with bounded, in-order prefetch.
+
+    Args:
+        num_workers (int): Decoder processes; 0 decodes lazily on the calling thread.
+        min_size (int, optional): Passed to `open_image` to enable JPEG draft decoding.
+        prefetch (int): Maximum number of images decoded ahead of the consumer.
+    """
+
+    def __init__(self, num_workers=0, min_size=None, prefetch=32):
+        self.open_fn = functools.partial(open_image, min_size=min_size)
+        self.prefetch = max(1, prefetch)
+        self.pool = ProcessPoolExecutor(num_workers) if num_workers > 0 else None
+
+    def load(self, image_files):
+        """Decode a list of images in parallel."""
+        if self.pool is None:
+            return [self.open_fn(image_file) for image_file in image_files]
+        return list(self.pool.map(self.open_fn, image_files))
+
+    def imap(self, image_files):
+        """Yield decoded images in the order of `image_files`, keeping `prefetch` in flight."""
+        if self.pool is None:
+            for image_file in image_files:
+                yield self.open_fn(image_file)
+            return
+        pending = collections.deque()
+        for image_file in image_files:
+            pending.append(self.pool.submit(self.open_fn, image_file))
+            if len(pending) >= self.prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,9 +3,11 @@ from io import BytesIO
 import base64
 
 import torch
-from transformers import StoppingCriteria
+from transformers import StoppingCriteria, LogitsProcessor
 from stingbee.constants import IMAGE_TOKEN_INDEX
+from stingbee.parity import tensor_parity
 import numpy as np
+import math
 
 def load_image_from_base64(image):
     return Image.open(BytesIO(base64.b64decode(image)))
@@ -25,15 +27,147 @@ def expand2square(pil_img, background_color):
         return result
 
 
+def resize_to_token_budget(pil_img, token_budget, patch_size=14):
+    """Resize to a patch grid of at most `token_budget` cells that keeps the aspect ratio."""
+    width, height = pil_img.size
+    aspect_ratio = width / height
+    grid_h = max(1, min(token_budget, round(math.sqrt(token_budget / aspect_ratio))))
+    grid_w = max(1, min(token_budget // grid_h, round(grid_h * aspect_ratio)))
+    return pil_img.resize((grid_w * patch_size, grid_h * patch_size), Image.BICUBIC)
+
+
+class BatchImageProcessor:
+    """Batched torch replacement for `expand2square` + `CLIPImageProcessor.preprocess`.
+
+    Works on uint8 pixels: optionally pads to a square with the mean color, resizes the
+    shortest edge to `size` with antialiased bicubic filtering, center crops to
+    `crop_size`, and normalizes with the CLIP mean/std straight into `dtype`. Images of
+    the same shape are resized together, and normalization runs once for the whole batch.
+    """
+
+    def __init__(self, image_mean, image_std, size=504, crop_size=None, pad_to_square=True,
+                 dtype=torch.float16, device='cpu'):
+        self.size = size
+        self.crop_size = crop_size if crop_size is not None else size
+        self.pad_to_square = pad_to_square
+        self.dtype = dtype
+        self.device = device
+        self.background = torch.tensor([int(x*255) for x in image_mean], dtype=torch.uint8).view(3, 1, 1)
+        self.mean = torch.tensor(image_mean, dtype=torch.float32, device=device).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor(image_std, dtype=torch.float32, device=device).view(1, 3, 1, 1) * 255
+
+    @classmethod
+    def from_image_processor(cls, image_processor, size=504, crop_size=None, **kwargs):
+        return cls(image_processor.image_mean, image_processor.image_std, size=size, crop_size=crop_size, **kwargs)
+
+    @staticmethod
+    def to_tensor(image):
+        """PIL image, (H, W, 3) uint8 array or (3, H, W) uint8 tensor -> (3, H, W) uint8 tensor."""
+        if isinstance(image, Image.Image):
+            image = np.asarray(image.convert('RGB'))
+        if isinstance(image, np.ndarray):
+            image = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+        return image
+
+    def pad(self, image):
+        _, height, width = image.shape
+        if width == height:
+            return image
+        side = max(width, height)
+        result = self.background.expand(3, side, side).clone()
+        top, left = (side - height) // 2, (side - width) // 2
+        result[:, top:top + height, left:left + width] = image
+        return result
+
+    def output_size(self, height, width):
+        # same rounding as the HF processor with size={'shortest_edge': size}
+        if height <= width:
+            return self.size, int(self.size * width / height)
+        return int(self.size * height / width), self.size
+
+    def resize(self, images):
+        """(B, 3, H, W) uint8 -> (B, 3, h, w) uint8 with the shortest edge at `size`."""
+        out_size = self.output_size(*images.shape[-2:])
+        if tuple(images.shape[-2:]) == out_size:
+            return images
+        # the antialiased torch kernel uses PIL's bicubic coefficient (a=-0.5), and rounding
+        # back to uint8 mirrors PIL.Image.resize
+        images = torch.nn.functional.interpolate(images.to(self.device, torch.float32), size=out_size, mode='bicubic',
+                                                 align_corners=False, antialias=True)
+        return images.round_().clamp_(0, 255).to(torch.uint8)
+
+    def center_crop(self, images):
+        height, width = images.shape[-2:]
+        top, left = (height - self.crop_size) // 2, (width - self.crop_size) // 2
+        return images[..., top:top + self.crop_size, left:left + self.crop_size]
+
+    def normalize(self, images):
+        images = images.to(self.device, torch.float32)
+        return ((images - self.mean) / self.std).to(self.dtype)
+
+    def pixels(self, images):
+        """Pad, resize and crop without normalizing: (B, 3, crop_size, crop_size) uint8."""
+        images = [self.to_tensor(image) for image in images]
+        if self.pad_to_square:
+            images = [self.pad(image) for image in images]
+        # images that share a shape are resized in one call
+        buckets = {}
+        for i, image in enumerate(images):
+            buckets.setdefault(tuple(image.shape), []).append(i)
+        resized = [None] * len(images)
+        for indices in buckets.values():
+            batch = self.center_crop(self.resize(torch.stack([images[i] for i in indices], dim=0)))
+            for i, image in zip(indices, batch):
+                resized[i] = image
+        return torch.stack(resized, dim=0)
+
+    def __call__(self, images):
+        return self.normalize(self.pixels(images))
+
+
+@torch.no_grad()
+def check_preprocess_parity(image_processor, images, size=504, pad_to_square=True, max_abs_tol=0.15, mean_abs_tol=0.01):
+    """Compare `BatchImageProcessor` with the PIL + `CLIPImageProcessor` path on the same images.
+
+    Both outputs are in normalized units, where one uint8 level is about 0.015.
+
+    Returns:
+        Tuple[bool, dict]: Whether both the max and mean absolute differences are within
+        tolerance, and the measured statistics.
+    """
+    reference = []
+    for image in images:
+        image = image.convert('RGB')
+        if pad_to_square:
+            image = expand2square(image, tuple(int(x*255) for x in image_processor.image_mean))
+        reference.append(image_processor.preprocess(image,crop_size ={'height': size, 'width': size},size = {'shortest_edge': size},return_tensors='pt')['pixel_values'][0])
+    reference = torch.stack(reference, dim=0)
+    fast = BatchImageProcessor.from_image_processor(image_processor, size=size, pad_to_square=pad_to_square, dtype=torch.float32)(images)
+    return tensor_parity(reference, fast, max_abs_tol=max_abs_tol, mean_abs_tol=mean_abs_tol)
+
+
 def process_images(images, image_processor, model_cfg):
     image_aspect_ratio = getattr(model_cfg, "image_aspect_ratio", None)
     new_images = []
+    if len(images) > 0 and all(torch.is_tensor(image) and image.dtype == torch.uint8 for image in images):
+        # pixels read from a PixelStore are already padded and resized
+        return BatchImageProcessor.from_image_processor(image_processor, size=images[0].shape[-1])(images)
+    if image_aspect_ratio == 'pad' and getattr(model_cfg, 'fast_image_preprocess', False):
+        return BatchImageProcessor.from_image_processor(image_processor, size=504)(images)
     if image_aspect_ratio == 'pad':
         for image in images:
             image = expand2square(image, tuple(int(x*255) for x in image_processor.image_mean))
             image = image_processor.preprocess(image,crop_size ={'height': 504, 'width': 504},size = {'shortest_edge': 504},return_tensors='pt')['pixel_values'][0]
             # image = image_processor.preprocess(image,return_tensors='pt')['pixel_values'][0]
 
+            new_images.append(image)
+    elif image_aspect_ratio == 'grid':
+        # no padding: every token covers scan content, the tower interpolates its
+        # position embeddings to the resulting HxW grid
+        token_budget = getattr(model_cfg, 'image_grid_token_budget', 1296)
+        for image in images:
+            image = resize_to_token_budget(image, token_budget)
+            image = image_processor.preprocess(image, do_resize=False, do_center_crop=False, return_tensors='pt')['pixel_values'][0]
             new_images.append(image)
     else:
         return image_processor(images, return_tensors='pt')['pixel_values']
@@ -41,7 +175,12 @@ def process_images(images, image_processor, model_cfg):
         new_images = torch.stack(new_images, dim=0)
     return new_images
 
-def process_images_demo(images, image_processor):
+def process_images_demo(images, image_processor, fast=False, model_cfg=None):
+    if getattr(model_cfg, 'image_aspect_ratio', None) == 'grid':
+        # the model sees the scan at its own aspect ratio, as in training and eval
+        return process_images(images, image_processor, model_cfg)
+    if fast:
+        return BatchImageProcessor.from_image_processor(image_processor, size=504)(images)
     new_images = []
     # image_aspect_ratio = 'pad'
     for image in images:
@@ -77,6 +216,21 @@ def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX
     return input_ids
 
 
+def left_pad_input_ids(input_ids_list, pad_token_id):
+    """Batch 1-D prompt ids for generation, padded on the left so every row ends in the last column.
+
+    Returns:
+        Tuple[torch.LongTensor, torch.LongTensor]: The (B, L) ids and their attention mask.
+    """
+    max_length = max(ids.shape[-1] for ids in input_ids_list)
+    input_ids = input_ids_list[0].new_full((len(input_ids_list), max_length), pad_token_id)
+    attention_mask = input_ids_list[0].new_zeros((len(input_ids_list), max_length))
+    for row, ids in enumerate(input_ids_list):
+        input_ids[row, max_length - ids.shape[-1]:] = ids
+        attention_mask[row, max_length - ids.shape[-1]:] = 1
+    return input_ids, attention_mask
+
+
 def get_model_name_from_path(model_path):
     model_path = model_path.strip("/")
     model_paths = model_path.split("/")
@@ -88,7 +242,19 @@ def get_model_name_from_path(model_path):
 
 
 
+# the vocabulary scan is done once per tokenizer and keyword set
+_ambiguous_token_ids = {}
+
+
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """Stops once every row of the batch has produced one of `keywords`.
+
+    Keyword ids live on the device after the first call, and every row is matched with
+    tensor ops; `done` holds the per-row mask. A row is only decoded to a string when its
+    last token could complete a keyword in a way the id match misses (a different
+    tokenization of the same text). `__call__` returns a bool, as transformers 4.31 expects.
+    """
+
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
         self.keyword_ids = []
@@ -102,20 +268,66 @@ class KeywordsStoppingCriteria(StoppingCriteria):
             self.keyword_ids.append(torch.tensor(cur_keyword_ids))
         self.tokenizer = tokenizer
         self.start_len = input_ids.shape[1]
+        self.candidate_ids = torch.tensor(self.ambiguous_token_ids(tokenizer, keywords), dtype=torch.long)
+        self.done = None
+
+    @staticmethod
+    def ambiguous_token_ids(tokenizer, keywords):
+        """Tokens whose text could end a keyword, plus byte-fallback tokens."""
+        key = (id(tokenizer), tuple(keywords))
+        if key in _ambiguous_token_ids:
+            return _ambiguous_token_ids[key]
+        last_chars = set(keyword[-1] for keyword in keywords if len(keyword) > 0)
+        ids = []
+        for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+            if token is None or token in tokenizer.all_special_tokens:
+                continue
+            if (token.startswith('<0x') and token.endswith('>')) or any(c in token for c in last_chars):
+                ids.append(token_id)
+        _ambiguous_token_ids[key] = ids
+        return ids
 
     def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        # assert output_ids.shape[0] == 1, "Only support batch size 1 (yet)"  # TODO
-        offset = min(output_ids.shape[1] - self.start_len, self.max_keyword_len)
-        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
+        device = output_ids.device
+        if self.keyword_ids[0].device != device:
+            self.keyword_ids = [keyword_id.to(device) for keyword_id in self.keyword_ids]
+            self.candidate_ids = self.candidate_ids.to(device)
+        num_new = output_ids.shape[1] - self.start_len
+        if self.done is None or self.done.shape[0] != output_ids.shape[0] or num_new <= 1:
+            # a new generate call
+            self.done = torch.zeros(output_ids.shape[0], dtype=torch.bool, device=device)
+        if num_new <= 0:
+            return False
+
         for keyword_id in self.keyword_ids:
-            if (output_ids[0, -keyword_id.shape[0]:] == keyword_id).all():
-                return True
-        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
-        flag=False
-        for output in outputs:
-                
-            for keyword in self.keywords:
-                if keyword in output:
-                    flag=True
-                    return flag
-        return flag
\ No newline at end of file
+            if keyword_id.shape[0] <= num_new:
+                self.done |= (output_ids[:, -keyword_id.shape[0]:] == keyword_id).all(dim=1)
+
+        ambiguous = ~self.done & torch.isin(output_ids[:, -1], self.candidate_ids)
+        if ambiguous.any():
+            rows = ambiguous.nonzero(as_tuple=True)[0]
+            offset = min(num_new, self.max_keyword_len)
+            outputs = self.tokenizer.batch_decode(output_ids[rows, -offset:], skip_special_tokens=True)
+            matched = [any(keyword in output for keyword in self.keywords) for output in outputs]
+            self.done[rows] |= torch.tensor(matched, dtype=torch.bool, device=device)
+        return bool(self.done.all())
+
+
+class FinishedRowsLogitsProcessor(LogitsProcessor):
+    """Forces EOS on rows a `KeywordsStoppingCriteria` has marked done, freezing them.
+
+    `generate` then treats those rows as finished and pads them, instead of letting them
+    run on until the slowest row of the batch stops.
+    """
+
+    def __init__(self, stopping_criteria, eos_token_id):
+        self.stopping_criteria = stopping_criteria
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        done = self.stopping_criteria.done
+        if done is None or done.shape[0] != scores.shape[0] or input_ids.shape[1] <= self.stopping_criteria.start_len:
+            return scores
+        forced = torch.full_like(scores[0], -float('inf'))
+        forced[self.eos_token_id] = 0
+        return torch.where(done[:, None], forced, scores)
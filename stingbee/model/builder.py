@@ -21,11 +21,36 @@ import copy
 from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, BitsAndBytesConfig
 import torch
 from stingbee.model import *
+from stingbee.model.embedding_cache import ImageEmbeddingCache
+from stingbee.model.onnx_vision import attach_onnx_vision_encoder
+from stingbee.mm_utils import process_images_demo
 from stingbee.constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+from stingbee.tokenizer_parity import check_tokenizer_parity, PROBE_QUESTIONS, probe_prompts
+
+
+def load_llama_tokenizer(tokenizer_path, use_fast_tokenizer=False, parity_questions=None):
+    """Slow SentencePiece tokenizer, or the fast one if it tokenizes exactly like it.
+
+    The fast tokenizer is only returned when `check_tokenizer_parity` finds no mismatch
+    over the probe prompts and `parity_questions`; otherwise this falls back with a
+    warning. `scripts/check_parity.py tokenizer` runs the full check over the instruct
+    JSON and the question files.
+    """
+    slow_tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=False)
+    if not use_fast_tokenizer:
+        return slow_tokenizer
+    fast_tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True)
+    passed, stats = check_tokenizer_parity(slow_tokenizer, fast_tokenizer, questions=PROBE_QUESTIONS + list(parity_questions or []),
+                                           prompts=probe_prompts())
+    if not passed:
+        warnings.warn(f"Fast tokenizer of {tokenizer_path} differs from the slow one in {stats['mismatches']}/{stats['compared']} "
+                      f"checks (first: {stats['examples'][0]}); using the slow tokenizer.")
+        return slow_tokenizer
+    return fast_tokenizer
 
 
 #def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda:2"):  # Hardcoding device to 'cuda:2'
-def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda"):
+def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda", token_budget=None, truncate_vision_tower=False, embedding_cache_bytes=0, embedding_cache_dir=None, embedding_cache_disk_bytes=10 * (1 << 30), patch_drop_threshold=None, image_grid_token_budget=None, vision_onnx_path=None, onnx_parity_check=True, onnx_parity_images=None, use_fast_tokenizer=False, tokenizer_parity_questions=None):
     kwargs = {"device_map": device_map}
 
     if load_8bit:
@@ -52,7 +77,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
         if 'lora' in model_name.lower() and model_base is not None:
             merge_lora_weights = True
             lora_cfg_pretrained = AutoConfig.from_pretrained(model_path)
-            tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False)
+            tokenizer = load_llama_tokenizer(model_base, use_fast_tokenizer, tokenizer_parity_questions)
             
             model = StingBeeLlamaForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, config=lora_cfg_pretrained, **kwargs)
             token_num, tokem_dim = model.lm_head.out_features, model.lm_head.in_features
@@ -112,7 +137,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
                 cfg_pretrained = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
                 model = StingBeeMPTForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, config=cfg_pretrained, **kwargs)
             else:
-                tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False)
+                tokenizer = load_llama_tokenizer(model_base, use_fast_tokenizer, tokenizer_parity_questions)
                 cfg_pretrained = AutoConfig.from_pretrained(model_path)
                 model = StingBeeLlamaForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, config=cfg_pretrained, **kwargs)
 
@@ -125,7 +150,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
                 model = StingBeeMPTForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
             else:
                 print("Loading StingBee......")
-                tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+                tokenizer = load_llama_tokenizer(model_path, use_fast_tokenizer, tokenizer_parity_questions)
                 model = StingBeeLlamaForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
     else:
         # Load language model
@@ -191,10 +216,30 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
                     model.state_dict()[adjusted_key].copy_(param)
          
         vision_tower.load_state_dict(vision_tower_state_dict, strict=False)
+        if truncate_vision_tower:
+            vision_tower.truncate_to_select_layer()
+        # skip near-empty background patches before the ViT; None runs every patch
+        model.config.mm_patch_drop_threshold = vision_tower.patch_drop_threshold = patch_drop_threshold
         print(f"Vision Tower moved to device {device}.")    
         vision_tower.to(device=device, dtype=torch.float16)
         image_processor = vision_tower.image_processor
 
+        # number of visual tokens per image sent to the LLM; None keeps all patches
+        model.config.mm_token_budget = token_budget
+        if image_grid_token_budget is not None:
+            # keep the aspect ratio of the scan instead of padding it to a square
+            model.config.image_aspect_ratio = 'grid'
+            model.config.image_grid_token_budget = image_grid_token_budget
+
+        if embedding_cache_bytes > 0:
+            model.image_embedding_cache = ImageEmbeddingCache(embedding_cache_bytes, embedding_cache_dir, embedding_cache_disk_bytes)
+
+        if vision_onnx_path is not None:
+            # run the vision tower and projector with onnxruntime (CPU nodes)
+            # checked against the PyTorch path on real scans (PIL images), padded to the native square
+            parity_images = process_images_demo(onnx_parity_images, image_processor) if onnx_parity_images else None
+            attach_onnx_vision_encoder(model, vision_onnx_path, parity_images, parity_check=onnx_parity_check)
+
     if hasattr(model.config, "max_sequence_length"):
         context_len = model.config.max_sequence_length
     else:
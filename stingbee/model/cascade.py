@@ -0,0 +1,79 @@
+import torch
+
+
+def finished_positions(new_tokens, eos_token_id):
+    """(B, T) mask of the positions after each row's first EOS, i.e. the padding."""
+    is_eos = new_tokens == eos_token_id
+    return (is_eos.long().cumsum(dim=1) - is_eos.long()) > 0
+
+
+def sequence_confidence(scores, new_tokens, eos_token_id=None, pad_token_id=None):
+    """Lowest probability the model gave to any of its own generated tokens, per row.
+
+    Args:
+        scores (Tuple[torch.FloatTensor]): Per-step logits as returned by `generate(output_scores=True)`.
+        new_tokens (torch.LongTensor): Generated tokens of shape (B, T), prompt excluded.
+        eos_token_id (int, optional): Everything after a row's first EOS is padding and ignored.
+        pad_token_id (int, optional): Padding written after a row finished; ignored when
+            `eos_token_id` is not given.
+    """
+    logprobs = torch.stack([torch.log_softmax(step.float(), dim=-1) for step in scores], dim=1)
+    new_tokens = new_tokens[:, :logprobs.shape[1]]
+    token_logprobs = logprobs.gather(-1, new_tokens[..., None])[..., 0]
+    if eos_token_id is not None:
+        token_logprobs = token_logprobs.masked_fill(finished_positions(new_tokens, eos_token_id), 0.0)
+    elif pad_token_id is not None:
+        token_logprobs = token_logprobs.masked_fill(new_tokens == pad_token_id, 0.0)
+    return token_logprobs.min(dim=1).values.exp()
+
+
+@torch.inference_mode()
+def cascade_generate(model, input_ids, images_low, images_high, confidence_threshold=0.9, escalate=None,
+                     pad_token_id=None, **generate_kwargs):
+    """Answer at low resolution first and re-run only the uncertain rows at full resolution.
+
+    Args:
+        model: A StingBee causal LM.
+        input_ids (torch.LongTensor): Batched prompt ids (B, L).
+        images_low (torch.Tensor): Images preprocessed at the cheap resolution (e.g. 336px).
+        images_high (Union[torch.Tensor, Callable]): Full resolution images, or a callable that
+            returns them for a list of row indices so only escalated rows are preprocessed.
+        confidence_threshold (float): Rows whose lowest token probability falls below this
+            are escalated.
+        escalate (torch.BoolTensor, optional): Rows that must always run at full resolution,
+            e.g. grounding and referring questions.
+
+    Returns:
+        Tuple[List[torch.LongTensor], torch.BoolTensor, torch.FloatTensor]: The generated tokens of
+        each row (prompt excluded), which rows were escalated and the low resolution confidence.
+    """
+    model.get_vision_tower().prepare_resolutions([images_low.shape[-1], model.get_vision_tower().native_image_size])
+
+    # finished rows are padded and their padding must not count against the confidence
+    if pad_token_id is None:
+        pad_token_id = model.generation_config.pad_token_id
+    eos_token_id = generate_kwargs.get('eos_token_id', model.generation_config.eos_token_id)
+    if isinstance(eos_token_id, (list, tuple)):
+        eos_token_id = eos_token_id[0]
+
+    input_len = input_ids.shape[1]
+    low = model.generate(input_ids, images=images_low, output_scores=True, return_dict_in_generate=True,
+                         pad_token_id=pad_token_id, **generate_kwargs)
+    new_tokens = low.sequences[:, input_len:]
+    confidence = sequence_confidence(low.scores, new_tokens, eos_token_id, pad_token_id)
+    outputs = list(new_tokens)
+
+    escalated = confidence < confidence_threshold
+    if escalate is not None:
+        escalated |= escalate.to(escalated.device)
+    if escalated.any():
+        rows = escalated.nonzero(as_tuple=True)[0].tolist()
+        high_images = images_high(rows) if callable(images_high) else images_high[rows]
+        row_kwargs = dict(generate_kwargs)
+        if row_kwargs.get('attention_mask') is not None:
+            row_kwargs['attention_mask'] = row_kwargs['attention_mask'][rows]
+        high = model.generate(input_ids[rows], images=high_images, pad_token_id=pad_token_id, **row_kwargs)
+        for row, output in zip(rows, high[:, input_len:]):
+            outputs[row] = output
+
+    return outputs, escalated, confidence
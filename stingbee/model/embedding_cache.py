@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+GB = 1 << 30
+
+
+def vision_signature(model):
+    """Everything besides the pixels that determines the projector output for an image of `model`.
+
+    Besides the checkpoint and feature settings this covers the token merging, the
+    patch dropping, the grid mode and the backend running the tower (PyTorch or an
+    exported ONNX graph, fp32 or int8), so a cache directory shared between runs never
+    returns features computed another way.
+    """
+    config = model.config
+    keys = ['_name_or_path', 'mm_vision_tower', 'mm_vision_select_layer', 'mm_vision_select_feature',
+            'mm_projector_type', 'mm_token_budget', 'mm_patch_drop_threshold', 'mm_patch_drop_white_level',
+            'image_aspect_ratio', 'image_grid_token_budget']
+    signature = {k: getattr(config, k, None) for k in keys}
+    onnx_encoder = getattr(model, 'onnx_vision_encoder', None)
+    signature['vision_backend'] = onnx_encoder.signature if onnx_encoder is not None else 'pytorch'
+    return json.dumps(signature, sort_keys=True, default=str)
+
+
+class ImageEmbeddingCache:
+    """Content-addressed cache of projector outputs keyed by the preprocessed pixels.
+
+    Entries are kept as fp16 CPU tensors in an LRU bounded by `max_bytes`. When a
+    `cache_dir` is given, evicted entries are spilled to `.npy` files there and read
+    back memory-mapped on a later hit; the files form a second LRU bounded by
+    `max_disk_bytes`.
+    """
+
+    def __init__(self, max_bytes=GB, cache_dir=None, max_disk_bytes=10 * GB):
+        self.max_bytes = int(max_bytes)
+        self.max_disk_bytes = int(max_disk_bytes)
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.disk_entries = OrderedDict()
+        self.cur_bytes = 0
+        self.disk_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # files left by earlier runs, oldest first
+            paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.npy')]
+            for path in sorted(paths, key=os.path.getmtime):
+                self.disk_entries[os.path.basename(path)[:-len('.npy')]] = os.path.getsize(path)
+                self.disk_bytes += os.path.getsize(path)
+            self._trim_disk()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, pixel_values, signature):
+        h = hashlib.sha1(signature.encode())
+        pixels = pixel_values.detach().to(device='cpu', dtype=torch.float16).contiguous()
+        h.update(str(tuple(pixels.shape)).encode())
+        h.update(pixels.numpy().tobytes())
+        return h.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if key in self.disk_entries:
+            with warnings.catch_warnings():
+                # the map is read-only and only ever copied from, on the transfer to the device
+                warnings.simplefilter('ignore', UserWarning)
+                features = torch.from_numpy(np.load(self._disk_path(key), mmap_mode='r'))
+            self.disk_entries.move_to_end(key)
+            self.disk_hits += 1
+            return features
+        self.misses += 1
+        return None
+
+    def put(self, key, features):
+        self._insert(key, features.detach().to(device='cpu', dtype=torch.float16).contiguous())
+
+    def _insert(self, key, features):
+        if key in self.entries:
+            return
+        self.entries[key] = features
+        self.cur_bytes += features.numel() * features.element_size()
+        while self.cur_bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_features = self.entries.popitem(last=False)
+            self.cur_bytes -= old_features.numel() * old_features.element_size()
+            self.evictions += 1
+            if self.cache_dir is not None and old_key not in self.disk_entries:
+                np.save(self._disk_path(old_key), old_features.numpy())
+                self.disk_entries[old_key] = os.path.getsize(self._disk_path(old_key))
+                self.disk_bytes += self.disk_entries[old_key]
+                self._trim_disk()
+
+    def _trim_disk(self):
+        while self.disk_bytes > self.max_disk_bytes and self.disk_entries:
+            old_key, size = self.disk_entries.popitem(last=False)
+            self.disk_bytes -= size
+            if os.path.exists(self._disk_path(old_key)):
+                os.remove(self._disk_path(old_key))
+
+    def encode(self, images, encode_fn, signature, device, dtype):
+        """Run `encode_fn` only on the images of the batch that are not cached yet."""
+        keys = [self.make_key(image, signature) for image in images]
+        results = [self.get(key) for key in keys]
+        miss_idx = [i for i, x in enumerate(results) if x is None]
+        if len(miss_idx) > 0:
+            if torch.is_tensor(images):
+                new_features = encode_fn(images[miss_idx])
+            else:
+                new_features = encode_fn([images[i] for i in miss_idx])
+            for i, features in zip(miss_idx, new_features):
+                self.put(keys[i], features)
+                results[i] = features
+
+        results = [x.to(device=device, dtype=dtype) for x in results]
+        if all(x.shape == results[0].shape for x in results):
+            return torch.stack(results, dim=0)
+        return results
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.cur_bytes,
+            "disk_entries": len(self.disk_entries),
+            "disk_bytes": self.disk_bytes,
+        }
+
+    def clear(self):
+        """Drop the in-memory entries and the statistics; spilled files stay on disk."""
+        self.entries.clear()
+        self.cur_bytes = 0
+        self.reset_stats()
@@ -0,0 +1,345 @@
+"""
+Grammar-constrained decoding of grounding and referring answers.
+
+Answers are matched character by character against a small NFA of the box syntax that
+`extract_substrings` and `visualize_all_bbox_together` parse:
+
+    grounding: <p>class</p> {<x0><y0><x1><y1>}{...} <p>class</p> {...}
+    refer:     {<x0><y0><x1><y1>}
+
+with integer coordinates in 0-100. A token is allowed when its text keeps the match
+alive, and EOS only once the answer is complete. Where the grammar leaves a single
+possible continuation (e.g. `ringe</p>` after `<p>sy`) the tokens are appended without
+running the model. When the token budget only leaves room for the shortest way to
+finish the answer, that is appended instead, so a truncated answer still parses.
+"""
+from collections import defaultdict
+
+import torch
+
+
+THREAT_CLASSES = [
+    "explosive", "gun", "3D printed gun", "knife", "cutter", "shaving Blade",
+    "shaving Razor", "lighter", "syringe", "battery", "nail cutter", "other sharp items",
+    "powerbank", "scissors", "hammer", "pliers", "wrench", "screwdriver", "handcuffs", "bullets"
+]
+
+# node kinds of the grammar graph; each node is (kind, argument, next node)
+_LITERAL, _CHOICE, _NUMBER, _SPACE, _BRANCH, _END = range(6)
+
+
+def _box_nodes(start, after):
+    """Nodes `start`.. of `{<n><n><n><n>}`, continuing at `after`."""
+    nodes = {start: (_LITERAL, "{<", start + 1)}
+    for i in range(4):
+        nodes[start + 1 + 2 * i] = (_NUMBER, 100, start + 2 + 2 * i)
+        nodes[start + 2 + 2 * i] = (_LITERAL, "><" if i < 3 else ">}", start + 3 + 2 * i if i < 3 else after)
+    return nodes
+
+
+def _grammar_nodes(mode, classes):
+    if mode == "refer":
+        nodes = {0: (_SPACE, None, 1), 99: (_END, None, None)}
+        nodes.update(_box_nodes(1, 99))
+        return nodes
+    if mode == "grounding":
+        nodes = {
+            0: (_SPACE, None, 1),
+            1: (_LITERAL, "<p>", 2),
+            2: (_CHOICE, tuple(classes), 3),
+            3: (_LITERAL, "</p>", 4),
+            4: (_SPACE, None, 5),
+            # another box for the same class, the next class, or the end
+            98: (_BRANCH, (5, 0, 99), None),
+            99: (_END, None, None),
+        }
+        nodes.update(_box_nodes(5, 98))
+        return nodes
+    raise ValueError(f"Unknown grammar mode: {mode}")
+
+
+class BoxGrammar:
+    """Character NFA over the box syntax, with token masks cached per state.
+
+    A state is a frozenset of (node, progress) items: the matched part of a literal,
+    class name or number at that node.
+
+    Args:
+        tokenizer: The tokenizer whose vocabulary is constrained.
+        mode (str): "grounding" or "refer".
+        classes (List[str]): Class names allowed between `<p>` and `</p>`.
+    """
+
+    def __init__(self, tokenizer, mode="grounding", classes=THREAT_CLASSES):
+        self.tokenizer = tokenizer
+        self.nodes = _grammar_nodes(mode, classes)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.vocab_size = len(tokenizer)
+        special = set(tokenizer.all_special_tokens)
+        self.token_strings = {}
+        self.tokens_by_first_char = defaultdict(list)
+        for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(self.vocab_size)))):
+            if token is None or token in special or (token.startswith("<0x") and token.endswith(">")):
+                continue
+            text = token.replace("▁", " ")
+            if text:
+                self.token_strings[token_id] = text
+                self.tokens_by_first_char[text[0]].append(token_id)
+        self.string_to_token = {}
+        for token_id, text in self.token_strings.items():
+            self.string_to_token.setdefault(text, token_id)
+        self.initial_state = self._closure({(0, None)})
+        self._steps = {}
+        self._masks = {}
+        self._forced = {}
+        self._completions = {}
+        self._shortest_suffixes()
+
+    def _closure(self, items):
+        closed, stack = set(), list(items)
+        while stack:
+            node, progress = stack.pop()
+            if (node, progress) in closed:
+                continue
+            closed.add((node, progress))
+            kind, argument, after = self.nodes[node]
+            if kind == _SPACE:
+                # the space is optional
+                stack.append((after, None))
+            elif kind == _BRANCH:
+                stack.extend((target, None) for target in argument)
+            elif kind == _CHOICE and progress in argument:
+                stack.append((after, None))
+            elif kind == _NUMBER and progress:
+                stack.append((after, None))
+            elif kind == _LITERAL and progress == len(argument):
+                stack.append((after, None))
+        return frozenset(closed)
+
+    def _step_char(self, state, char):
+        key = (state, char)
+        if key not in self._steps:
+            items = set()
+            for node, progress in state:
+                kind, argument, _ = self.nodes[node]
+                if kind == _LITERAL:
+                    i = progress or 0
+                    if i < len(argument) and argument[i] == char:
+                        items.add((node, i + 1))
+                elif kind == _CHOICE:
+                    prefix = (progress or "") + char
+                    if any(name.startswith(prefix) for name in argument):
+                        items.add((node, prefix))
+                elif kind == _NUMBER:
+                    if char in self._next_digits(progress, argument):
+                        items.add((node, (progress or "") + char))
+                elif kind == _SPACE and progress is None and char == " ":
+                    items.add((node, " "))
+            self._steps[key] = self._closure(items) if items else None
+        return self._steps[key]
+
+    @staticmethod
+    def _next_digits(digits, maximum):
+        # no leading zeros
+        if digits == "0":
+            return ""
+        return "".join(char for char in "0123456789" if int((digits or "") + char) <= maximum)
+
+    def step(self, state, text):
+        """The state after `text`, or None if the grammar does not allow it."""
+        for char in text:
+            state = self._step_char(state, char)
+            if state is None:
+                return None
+        return state
+
+    def is_complete(self, state):
+        return any(self.nodes[node][0] == _END for node, _ in state)
+
+    def next_chars(self, state):
+        chars = set()
+        for node, progress in state:
+            kind, argument, _ = self.nodes[node]
+            if kind == _LITERAL and (progress or 0) < len(argument):
+                chars.add(argument[progress or 0])
+            elif kind == _CHOICE:
+                prefix = progress or ""
+                chars.update(name[len(prefix)] for name in argument if name.startswith(prefix) and len(name) > len(prefix))
+            elif kind == _NUMBER:
+                chars.update(self._next_digits(progress, argument))
+            elif kind == _SPACE and progress is None:
+                chars.add(" ")
+        return chars
+
+    def allowed_mask(self, state, device):
+        """(vocab,) bool mask of the tokens allowed in `state`."""
+        key = (state, device)
+        if key not in self._masks:
+            mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+            for char in self.next_chars(state):
+                for token_id in self.tokens_by_first_char[char]:
+                    if self.step(state, self.token_strings[token_id]) is not None:
+                        mask[token_id] = True
+            if self.is_complete(state):
+                mask[self.eos_token_id] = True
+            self._masks[key] = mask.to(device)
+        return self._masks[key]
+
+    def encode(self, text):
+        """Tokens of `text` as the tokenizer segments it, for text following earlier tokens.
+
+        The text is encoded after a newline, which is dropped again, so SentencePiece does
+        not add its word-start marker. Merges across the boundary with the preceding token
+        are not considered. If the result does not spell `text` in the vocabulary the
+        grammar sees, the longest vocabulary entry is taken at each point instead.
+        """
+        prefix = self.tokenizer.encode("\n", add_special_tokens=False)
+        tokens = self.tokenizer.encode("\n" + text, add_special_tokens=False)
+        if tokens[:len(prefix)] == prefix:
+            tokens = tokens[len(prefix):]
+        if all(token in self.token_strings for token in tokens) and "".join(self.token_strings[token] for token in tokens) == text:
+            return tokens
+        tokens = []
+        while text:
+            n = next(n for n in range(len(text), 0, -1) if text[:n] in self.string_to_token)
+            tokens.append(self.string_to_token[text[:n]])
+            text = text[n:]
+        return tokens
+
+    def forced_tokens(self, state):
+        """Tokens of the only continuation the grammar allows from `state`, if any."""
+        if state not in self._forced:
+            text, current = "", state
+            while not self.is_complete(current):
+                chars = self.next_chars(current)
+                if len(chars) != 1:
+                    break
+                char = chars.pop()
+                text += char
+                current = self._step_char(current, char)
+            self._forced[state] = self.encode(text)
+        return self._forced[state]
+
+    def _shortest_suffixes(self):
+        # shortest text from the start of each node to the end of the answer
+        self.suffixes = {node: None for node in self.nodes}
+        for _ in range(len(self.nodes)):
+            for node in self.nodes:
+                text = self._item_suffix(node, None)
+                if text is not None and (self.suffixes[node] is None or len(text) < len(self.suffixes[node])):
+                    self.suffixes[node] = text
+
+    def _item_suffix(self, node, progress):
+        kind, argument, after = self.nodes[node]
+        if kind == _END:
+            return ""
+        if kind == _BRANCH:
+            texts = [self.suffixes[target] for target in argument if self.suffixes[target] is not None]
+            return min(texts, key=len) if texts else None
+        rest = self.suffixes[after]
+        if rest is None:
+            return None
+        if kind == _LITERAL:
+            return argument[progress or 0:] + rest
+        if kind == _CHOICE:
+            prefix = progress or ""
+            return min((name for name in argument if name.startswith(prefix)), key=len)[len(prefix):] + rest
+        if kind == _NUMBER:
+            return ("" if progress else "0") + rest
+        return rest
+
+    def completion_tokens(self, state):
+        """Tokens of the shortest text that completes the answer from `state`."""
+        if state not in self._completions:
+            text = min((self._item_suffix(node, progress) for node, progress in state), key=len)
+            self._completions[state] = self.encode(text)
+        return self._completions[state]
+
+
+def grammar_mask(grammar, state, device):
+    """Allowed tokens in `state`; only EOS once the row is finished or has left the grammar."""
+    if state is not None:
+        mask = grammar.allowed_mask(state, device)
+        if mask.any():
+            return mask
+    mask = torch.zeros(grammar.vocab_size, dtype=torch.bool, device=device)
+    mask[grammar.eos_token_id] = True
+    return mask
+
+
+@torch.inference_mode()
+def generate_with_grammar(model, input_ids, attention_mask, grammars, images=None, image_features=None,
+                          max_new_tokens=256, pad_token_id=0):
+    """Greedy decoding within each row's grammar, skipping the forward pass over forced tokens.
+
+    After each sampled token the tokens of the only continuation the grammar allows are
+    appended as well, and the next forward pass feeds them together. Rows feeding fewer
+    tokens in a step are padded with masked positions. Room for the shortest completion
+    of the answer is kept in `max_new_tokens`: once a sampled token would eat into it,
+    the row appends that completion instead and finishes.
+
+    Args:
+        model: A StingBee causal LM.
+        input_ids (torch.LongTensor): Left-padded prompts (B, L), as passed to `generate`.
+        attention_mask (torch.Tensor): Their (B, L) mask.
+        grammars (List[BoxGrammar]): One grammar per row.
+
+    Returns:
+        Tuple[torch.LongTensor, int]: Prompts followed by the generated tokens (padded with
+        `pad_token_id`), like `generate` returns, and the number of forward passes run.
+    """
+    outputs = model(input_ids=input_ids, attention_mask=attention_mask, images=images, image_features=image_features,
+                    use_cache=True, return_dict=True)
+    past_key_values, full_mask = outputs.past_key_values, outputs.attention_mask
+    logits = outputs.logits[:, -1, :]
+    num_forwards = 1
+    states = [grammar.initial_state for grammar in grammars]
+    answers = [[] for _ in grammars]
+    active = list(range(len(grammars)))
+    while True:
+        masks = torch.stack([grammar_mask(grammars[row], states[row], logits.device) for row in active])
+        next_tokens = logits[active].masked_fill(~masks, -float('inf')).argmax(dim=-1).tolist()
+        feeds = {}
+        for row, token in zip(active, next_tokens):
+            grammar = grammars[row]
+            if token == grammar.eos_token_id:
+                answers[row].append(token)
+                continue
+            state = grammar.step(states[row], grammar.token_strings[token])
+            tokens = [token] + grammar.forced_tokens(state)
+            for forced in tokens[1:]:
+                state = grammar.step(state, grammar.token_strings[forced])
+            if len(answers[row]) + len(tokens) + len(grammar.completion_tokens(state)) > max_new_tokens:
+                # no room left to finish after this token: close the answer now
+                tokens = grammar.completion_tokens(states[row])[:max_new_tokens - len(answers[row])]
+                answers[row].extend(tokens)
+                if len(answers[row]) < max_new_tokens:
+                    answers[row].append(grammar.eos_token_id)
+                continue
+            states[row] = state
+            answers[row].extend(tokens)
+            if len(answers[row]) < max_new_tokens:
+                feeds[row] = tokens
+        active = list(feeds)
+        if not active:
+            break
+
+        width = max(len(tokens) for tokens in feeds.values())
+        step_ids = input_ids.new_full((input_ids.shape[0], width), pad_token_id)
+        step_mask = full_mask.new_zeros((input_ids.shape[0], width))
+        for row, tokens in feeds.items():
+            step_ids[row, :len(tokens)] = torch.tensor(tokens, dtype=step_ids.dtype)
+            step_mask[row, :len(tokens)] = 1
+        full_mask = torch.cat([full_mask, step_mask], dim=1)
+        outputs = model(input_ids=step_ids, attention_mask=full_mask, past_key_values=past_key_values, use_cache=True, return_dict=True)
+        num_forwards += 1
+        past_key_values = outputs.past_key_values
+        # each row continues from its last fed token
+        last = torch.tensor([len(feeds.get(row, [0])) - 1 for row in range(input_ids.shape[0])], device=step_ids.device)
+        logits = outputs.logits[torch.arange(input_ids.shape[0], device=last.device), last]
+
+    width = max(len(answer) for answer in answers)
+    output_ids = input_ids.new_full((input_ids.shape[0], width), pad_token_id)
+    for row, answer in enumerate(answers):
+        output_ids[row, :len(answer)] = torch.tensor(answer, dtype=output_ids.dtype)
+    return torch.cat([input_ids, output_ids], dim=1), num_forwards
@@ -0,0 +1,238 @@
+import collections
+
+import torch
+
+from stingbee.constants import IMAGE_TOKEN_INDEX
+from stingbee.mm_utils import left_pad_input_ids
+from .stingbee_arch import position_ids_from_attention_mask
+
+
+def split_at_image(input_ids):
+    """Split 1-D prompt ids after the last image token.
+
+    With the llava templates everything up to there (system prompt, role prefix and
+    image) is the same for every question on an image.
+
+    Returns:
+        Tuple[torch.LongTensor, torch.LongTensor]: The shared prefix and the question suffix.
+    """
+    image_positions = (input_ids == IMAGE_TOKEN_INDEX).nonzero(as_tuple=True)[0]
+    if image_positions.numel() == 0:
+        raise ValueError("The prompt has no image token to share a prefix up to.")
+    end = int(image_positions[-1]) + 1
+    if end == input_ids.shape[0]:
+        raise ValueError("The prompt ends with its image token; there is no question to decode from.")
+    return input_ids[:end], input_ids[end:]
+
+
+class PrefixCache:
+    """`past_key_values` of prompt prefixes with the image features spliced in.
+
+    Each prefix is prefilled once and forked for every question asked about its image,
+    so the 1296 image tokens are not run through the LLM again per question.
+
+    Args:
+        past_key_values (Tuple[Tuple[torch.Tensor]]): Per layer (key, value) of shape (B, H, P, D).
+        attention_mask (torch.Tensor): (B, P) mask of the spliced prefixes.
+    """
+
+    def __init__(self, past_key_values, attention_mask):
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+
+    @classmethod
+    @torch.inference_mode()
+    def prefill(cls, model, prefix_ids, attention_mask, images=None, image_features=None):
+        _, attention_mask, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+            prefix_ids, attention_mask, None, None, images, image_features)
+        # the LM head is not needed: decoding starts from the question suffix
+        outputs = model.get_model()(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                                    position_ids=position_ids_from_attention_mask(attention_mask), use_cache=True, return_dict=True)
+        return cls(outputs.past_key_values, attention_mask)
+
+    def __len__(self):
+        return self.attention_mask.shape[0]
+
+    def fork(self, repeats):
+        """Cache and mask with prefix `i` repeated `repeats[i]` times along the batch."""
+        if len(self) == 1:
+            # a view; the first decoding step copies it when it appends the suffix
+            n = repeats[0]
+            return (tuple(tuple(t.expand(n, *t.shape[1:]) for t in layer) for layer in self.past_key_values),
+                    self.attention_mask.expand(n, -1))
+        index = torch.repeat_interleave(torch.arange(len(self), device=self.attention_mask.device),
+                                        torch.tensor(repeats, device=self.attention_mask.device))
+        return (tuple(tuple(t.index_select(0, index) for t in layer) for layer in self.past_key_values),
+                self.attention_mask.index_select(0, index))
+
+
+@torch.inference_mode()
+def generate_with_shared_prefix(model, input_ids, attention_mask, group_sizes, images=None, image_features=None,
+                                max_new_tokens=256, pad_token_id=0, eos_token_id=None, stopping_criteria=None, logits_processor=None):
+    """Greedy decoding of questions that share images, prefilling each image prefix once.
+
+    Args:
+        model: A StingBee causal LM.
+        input_ids (torch.LongTensor): Left-padded prompts (B, L), as passed to `generate`.
+        attention_mask (torch.Tensor): Their (B, L) mask.
+        group_sizes (List[int]): Consecutive rows asked about the same images; one entry
+            per group, with the group's images (or image features) in `images`.
+        stopping_criteria, logits_processor: Lists of callables as taken by `generate`.
+
+    Returns:
+        torch.LongTensor: Prompts followed by the generated tokens, like `generate` returns.
+    """
+    rows = [ids[mask.bool()] for ids, mask in zip(input_ids, attention_mask)]
+    splits = [split_at_image(row) for row in rows]
+    prefixes, start = [], 0
+    for size in group_sizes:
+        prefix = splits[start][0]
+        if any(not torch.equal(prefix, splits[r][0]) for r in range(start + 1, start + size)):
+            raise ValueError(f"Rows {start}-{start + size - 1} do not share the prompt up to their image.")
+        prefixes.append(prefix)
+        start += size
+
+    cache = PrefixCache.prefill(model, *left_pad_input_ids(prefixes, pad_token_id), images=images, image_features=image_features)
+    past_key_values, prefix_mask = cache.fork(group_sizes)
+    suffix_ids, suffix_mask = left_pad_input_ids([suffix for _, suffix in splits], pad_token_id)
+    # padding between prefix and question is masked and skipped by the position ids
+    full_mask = torch.cat([prefix_mask.to(suffix_mask.dtype), suffix_mask], dim=1)
+    outputs = model(input_ids=suffix_ids, attention_mask=full_mask, past_key_values=past_key_values, use_cache=True, return_dict=True)
+
+    sequences = input_ids
+    finished = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+    for _ in range(max_new_tokens):
+        scores = outputs.logits[:, -1, :]
+        for processor in logits_processor or []:
+            scores = processor(sequences, scores)
+        next_tokens = scores.argmax(dim=-1).masked_fill(finished, pad_token_id)
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=1)
+        if eos_token_id is not None:
+            finished |= next_tokens == eos_token_id
+        if finished.all() or any(criteria(sequences, scores) for criteria in stopping_criteria or []):
+            break
+        full_mask = torch.cat([full_mask, full_mask.new_ones((full_mask.shape[0], 1))], dim=1)
+        outputs = model(input_ids=next_tokens[:, None], attention_mask=full_mask, past_key_values=outputs.past_key_values,
+                        use_cache=True, return_dict=True)
+    return sequences
+
+
+def _same_images(a, b):
+    if a is b:
+        return True
+    if a is None or b is None or a.shape != b.shape:
+        return False
+    return torch.equal(a, b)
+
+
+class SessionCache:
+    """KV cache of the last prompt and answer of a chat session.
+
+    Every turn resends the whole history. The next prompt is prefilled only from where
+    it stops matching the cached tokens, so the image tokens, earlier turns and the last
+    answer are not run through the LLM again. Reuse requires the same images and a common prefix that
+    covers every image token; otherwise the prompt is prefilled from scratch.
+    """
+
+    def __init__(self):
+        self.input_ids = None
+        self.past_key_values = None
+        self.images = None
+
+    @property
+    def nbytes(self):
+        if self.past_key_values is None:
+            return 0
+        # the memory held, not the size of the views
+        storages = {t.untyped_storage().data_ptr(): t.untyped_storage().nbytes() for layer in self.past_key_values for t in layer}
+        return sum(storages.values())
+
+    @staticmethod
+    def _forward(model, input_ids, past_key_values=None, images=None):
+        past_len = 0 if past_key_values is None else past_key_values[0][0].shape[-2]
+        attention_mask = torch.ones((1, past_len + input_ids.shape[0]), dtype=torch.long, device=input_ids.device)
+        input_ids, attention_mask, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+            input_ids[None], attention_mask, past_key_values, None, images)
+        length = (input_ids if input_ids is not None else inputs_embeds).shape[1]
+        outputs = model.get_model()(input_ids=input_ids, inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                                    position_ids=position_ids_from_attention_mask(attention_mask)[:, -length:],
+                                    past_key_values=past_key_values, use_cache=True, return_dict=True)
+        return outputs.past_key_values
+
+    @torch.inference_mode()
+    def prefill(self, model, input_ids, images=None):
+        """Prefill the 1-D prompt `input_ids` except its last token, which `generate` feeds.
+
+        Returns:
+            Tuple[Tuple[Tuple[torch.Tensor]], torch.LongTensor]: `past_key_values` and the
+            matching attention mask (one longer) to pass to `generate` with the full prompt.
+        """
+        input_ids = input_ids[:-1]
+        reuse = 0
+        if self.input_ids is not None and _same_images(self.images, images):
+            n = min(self.input_ids.shape[0], input_ids.shape[0])
+            mismatch = (self.input_ids[:n] != input_ids[:n]).nonzero(as_tuple=True)[0]
+            common = int(mismatch[0]) if mismatch.numel() > 0 else n
+            image_positions = (input_ids == IMAGE_TOKEN_INDEX).nonzero(as_tuple=True)[0]
+            if image_positions.numel() > 0 and common > int(image_positions[-1]):
+                reuse = common
+
+        if reuse > 0:
+            # every image is inside the common prefix, so the spliced offset is the cached one
+            cached_len = self.past_key_values[0][0].shape[-2]
+            spliced = reuse + cached_len - self.input_ids.shape[0]
+            past_key_values = self.past_key_values
+            if spliced < cached_len:
+                past_key_values = tuple(tuple(t[:, :, :spliced] for t in layer) for layer in past_key_values)
+            if reuse < input_ids.shape[0]:
+                past_key_values = self._forward(model, input_ids[reuse:], past_key_values)
+            elif spliced < cached_len:
+                # copied, so the positions past the common prefix are freed
+                past_key_values = tuple(tuple(t.clone() for t in layer) for layer in past_key_values)
+        else:
+            past_key_values = self._forward(model, input_ids, images=images)
+
+        self.input_ids, self.past_key_values, self.images = input_ids, past_key_values, images
+        past_len = past_key_values[0][0].shape[-2]
+        return past_key_values, torch.ones((1, past_len + 1), dtype=torch.long, device=input_ids.device)
+
+
+class SessionCacheStore:
+    """Session caches of all chat sessions, evicting the least recently used over `max_bytes`."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.sessions = collections.OrderedDict()
+
+    @property
+    def nbytes(self):
+        return sum(cache.nbytes for cache in self.sessions.values())
+
+    @torch.inference_mode()
+    def generate(self, session_id, model, input_ids, images=None, **generate_kwargs):
+        """`model.generate` on the (1, L) prompt `input_ids`, prefilling only what the session lacks.
+
+        The cache then holds the prompt and the answer, so the next turn only prefills
+        the text added after it.
+        """
+        cache = self.sessions.pop(session_id, None) or SessionCache()
+        past_key_values, attention_mask = cache.prefill(model, input_ids[0], images)
+        # `generate` of transformers 4.31 does not return the cache, even with
+        # `return_dict_in_generate`; it is taken from the last forward pass instead
+        last = {}
+        handle = model.register_forward_hook(lambda module, args, outputs: last.update(past_key_values=outputs.past_key_values))
+        try:
+            output_ids = model.generate(input_ids, past_key_values=past_key_values, attention_mask=attention_mask, **generate_kwargs)
+        finally:
+            handle.remove()
+        if "past_key_values" in last:
+            # the last sampled token has not been fed yet
+            cache.input_ids, cache.past_key_values = output_ids[0, :-1], last["past_key_values"]
+        self.sessions[session_id] = cache
+        while self.sessions and self.nbytes > self.max_bytes:
+            # a session larger than the whole budget is not kept either
+            self.sessions.popitem(last=False)
+        return output_ids
+
+    def reset(self, session_id):
+        self.sessions.pop(session_id, None)
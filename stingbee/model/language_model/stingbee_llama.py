@@ -13,7 +13,8 @@
 #    limitations under the License.
 
 
-from typing import List, Optional, Tuple, Union
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -24,7 +25,13 @@ from transformers import AutoConfig, AutoModelForCausalLM, \
 
 from transformers.modeling_outputs import CausalLMOutputWithPast
 
-from ..stingbee_arch import StingBeeMetaModel, StingBeeMetaForCausalLM
+from ..stingbee_arch import StingBeeMetaModel, StingBeeMetaForCausalLM, position_ids_from_attention_mask
+
+
+@dataclass
+class StingBeeCausalLMOutputWithPast(CausalLMOutputWithPast):
+    # mask of the sequence with the image features spliced in; `generate` carries it to the next step
+    attention_mask: Optional[torch.Tensor] = None
 
 
 class StingBeeConfig(LlamaConfig):
@@ -65,6 +72,8 @@ class StingBeeLlamaForCausalLM(LlamaForCausalLM, StingBeeMetaForCausalLM):
         output_hidden_states: Optional[bool] = None,
         images: Optional[torch.FloatTensor] = None,
         return_dict: Optional[bool] = None,
+        image_features: Optional[torch.FloatTensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -72,12 +81,17 @@ class StingBeeLlamaForCausalLM(LlamaForCausalLM, StingBeeMetaForCausalLM):
         )
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
-        input_ids, attention_mask, past_key_values, inputs_embeds, labels = self.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, labels, images)
+        input_ids, attention_mask, past_key_values, inputs_embeds, labels = self.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, labels, images, image_features)
+
+        if position_ids is None and attention_mask is not None:
+            # left-padded rows start counting at their first real token, as they would alone
+            position_ids = position_ids_from_attention_mask(attention_mask)[:, -(input_ids if input_ids is not None else inputs_embeds).shape[1]:]
 
         # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
         outputs = self.model(
             input_ids=input_ids,
             attention_mask=attention_mask,
+            position_ids=position_ids,
             past_key_values=past_key_values,
             inputs_embeds=inputs_embeds,
             use_cache=use_cache,
@@ -106,14 +120,23 @@ class StingBeeLlamaForCausalLM(LlamaForCausalLM, StingBeeMetaForCausalLM):
             output = (logits,) + outputs[1:]
             return (loss,) + output if loss is not None else output
 
-        return CausalLMOutputWithPast(
+        return StingBeeCausalLMOutputWithPast(
             loss=loss,
             logits=logits,
             past_key_values=outputs.past_key_values,
             hidden_states=outputs.hidden_states,
             attentions=outputs.attentions,
+            attention_mask=attention_mask if labels is None else None,
         )
 
+    def _update_model_kwargs_for_generation(self, outputs, model_kwargs: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
+        model_kwargs = super()._update_model_kwargs_for_generation(outputs, model_kwargs, *args, **kwargs)
+        attention_mask = getattr(outputs, "attention_mask", None)
+        if attention_mask is not None:
+            # extend the spliced mask rather than the prompt-level one, which is shorter by the image features
+            model_kwargs["attention_mask"] = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1)
+        return model_kwargs
+
     def prepare_inputs_for_generation(
         self, input_ids, past_key_values=None, attention_mask=None, inputs_embeds=None, **kwargs
     ):
@@ -132,6 +155,7 @@ class StingBeeLlamaForCausalLM(LlamaForCausalLM, StingBeeMetaForCausalLM):
                 "use_cache": kwargs.get("use_cache"),
                 "attention_mask": attention_mask,
                 "images": kwargs.get("images", None),
+                "image_features": kwargs.get("image_features", None),
             }
         )
         return model_inputs
@@ -79,10 +79,17 @@ class CLIPVisionTower(nn.Module):
         super().__init__()
 
         self.is_loaded = False
+        self.is_truncated = False
 
         self.vision_tower_name = vision_tower
         self.select_layer = args.mm_vision_select_layer
         self.select_feature = getattr(args, 'mm_vision_select_feature', 'patch')
+        # patches whose pixel std (in [0, 1] units) falls below this are dropped; None disables it
+        self.patch_drop_threshold = getattr(args, 'mm_patch_drop_threshold', None)
+        self.patch_drop_white_level = getattr(args, 'mm_patch_drop_white_level', 0.95)
+        self.last_drop_report = []
+        self.patch_drop_stats = {"images": 0, "tokens": 0, "dropped": 0}
+        self.grid_pos_embeds = {}
         
 
         if not delay_load:
@@ -122,8 +129,26 @@ class CLIPVisionTower(nn.Module):
         self.is_loaded = True
         # print(self.is_loaded)
 
+    def truncate_to_select_layer(self):
+        """Drop the encoder layers after `mm_vision_select_layer` (inference only).
+
+        The tower then returns the selected activation as its last hidden state, so the
+        discarded layers are never computed and no intermediate hidden states are kept.
+        """
+        if self.is_truncated:
+            return
+        encoder = self.vision_tower.vision_model.encoder
+        # hidden_states holds the embedding output followed by one entry per layer
+        num_layers = self.select_layer % (len(encoder.layers) + 1)
+        encoder.layers = nn.ModuleList(encoder.layers[:num_layers])
+        self.vision_tower.config.num_hidden_layers = num_layers
+        self.is_truncated = True
+
     def feature_select(self, image_forward_outs):
-        image_features = image_forward_outs.hidden_states[self.select_layer]
+        if self.is_truncated:
+            image_features = image_forward_outs.last_hidden_state
+        else:
+            image_features = image_forward_outs.hidden_states[self.select_layer]
         if self.select_feature == 'patch':
             image_features = image_features[:, 1:]
         elif self.select_feature == 'cls_patch':
@@ -132,29 +157,153 @@ class CLIPVisionTower(nn.Module):
             raise ValueError(f'Unexpected select feature: {self.select_feature}')
         return image_features
 
+    @staticmethod
+    def shape_buckets(images):
+        """Group the indices of a list of images by tensor shape, keeping first-seen order."""
+        buckets = {}
+        for idx, image in enumerate(images):
+            buckets.setdefault(tuple(image.shape), []).append(idx)
+        return buckets
+
     @torch.no_grad()
     def forward(self, images):
         if type(images) is list:
-            image_features = []
-            for image in images:
-                
-                image_forward_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
-                
-                image_feature = self.feature_select(image_forward_out).to(image.dtype)
-                
-                
-                image_features.append(image_feature)
+            # run each group of same-shaped images as one stacked batch and
+            # scatter the (num_patches, hidden) features back in input order
+            image_features = [None] * len(images)
+            for indices in self.shape_buckets(images).values():
+                bucket = torch.stack([images[idx] for idx in indices], dim=0)
+                bucket_features = self.forward_batch(bucket)
+                for idx, image_feature in zip(indices, bucket_features):
+                    image_features[idx] = image_feature
         else:
-            
-            image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
-            image_features = self.feature_select(image_forward_outs).to(images.dtype)
-            
-            
+            image_features = self.forward_batch(images)
 
         return image_features
-    
-   
-   
+
+    def forward_batch(self, images):
+        if self.patch_drop_threshold is not None:
+            return self.forward_content_patches(images)
+        if self.grid_shape(images) != self.native_grid_shape:
+            return self.forward_grid(images)
+        image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=not self.is_truncated)
+        image_features = self.feature_select(image_forward_outs).to(images.dtype)
+        return image_features
+
+    @property
+    def native_grid_shape(self):
+        num_positions = self.vision_tower.vision_model.embeddings.position_embedding.num_embeddings - 1
+        side = int(math.sqrt(num_positions))
+        return side, side
+
+    @property
+    def native_image_size(self):
+        return self.native_grid_shape[0] * self.config.patch_size
+
+    def prepare_resolutions(self, image_sizes):
+        """Precompute the position embeddings of several square input sizes side by side."""
+        for image_size in image_sizes:
+            grid_size = image_size // self.config.patch_size
+            self.grid_position_embedding(grid_size, grid_size)
+
+    def grid_shape(self, images):
+        patch_size = self.config.patch_size
+        return images.shape[-2] // patch_size, images.shape[-1] // patch_size
+
+    def grid_position_embedding(self, grid_h, grid_w):
+        """Position embeddings of shape (1 + grid_h * grid_w, hidden) for an HxW patch grid.
+
+        The square table of the tower is bicubically interpolated (the class token
+        embedding is kept as is) and the result is cached per grid shape.
+        """
+        weight = self.vision_tower.vision_model.embeddings.position_embedding.weight
+        if (grid_h, grid_w) == self.native_grid_shape:
+            return weight
+        key = (grid_h, grid_w, weight.device, weight.dtype, weight.data_ptr())
+        if key not in self.grid_pos_embeds:
+            side, _ = self.native_grid_shape
+            hidden_dim = weight.shape[-1]
+            with torch.no_grad():
+                pos_embedding_img = weight[1:].float().reshape(1, side, side, hidden_dim).permute(0, 3, 1, 2)
+                pos_embedding_img = nn.functional.interpolate(
+                    pos_embedding_img,
+                    size=(grid_h, grid_w),
+                    mode='bicubic',
+                    align_corners=True,
+                )
+                pos_embedding_img = pos_embedding_img.permute(0, 2, 3, 1).reshape(grid_h * grid_w, hidden_dim)
+                self.grid_pos_embeds[key] = torch.cat([weight[:1], pos_embedding_img.to(weight.dtype)], dim=0)
+        return self.grid_pos_embeds[key]
+
+    def embed_patches(self, images):
+        """Class token and patch embeddings (position embeddings included) for any patch grid."""
+        embeddings = self.vision_tower.vision_model.embeddings
+        patch_embeds = embeddings.patch_embedding(images)
+        pos_embeds = self.grid_position_embedding(*patch_embeds.shape[-2:])
+        patch_embeds = patch_embeds.flatten(2).transpose(1, 2) + pos_embeds[1:]
+        class_embeds = embeddings.class_embedding.to(patch_embeds.dtype) + pos_embeds[0]
+        return class_embeds, patch_embeds
+
+    def forward_grid(self, images):
+        """Run the ViT on a non-square (or non-native) patch grid."""
+        vision_model = self.vision_tower.vision_model
+        dtype = images.dtype
+        images = images.to(device=self.device, dtype=self.dtype)
+        class_embeds, patch_embeds = self.embed_patches(images)
+        hidden_states = torch.cat([class_embeds.expand(patch_embeds.shape[0], 1, -1), patch_embeds], dim=1)
+        hidden_states = vision_model.pre_layrnorm(hidden_states)
+        encoder_outs = vision_model.encoder(inputs_embeds=hidden_states, output_hidden_states=not self.is_truncated)
+        return self.feature_select(encoder_outs).to(dtype)
+
+    def background_patch_mask(self, images):
+        """True for patches that are near-uniform or pure (near-white) background."""
+        patch_size = self.config.patch_size
+        mean = torch.tensor(self.image_processor.image_mean, device=images.device).view(1, -1, 1, 1)
+        std = torch.tensor(self.image_processor.image_std, device=images.device).view(1, -1, 1, 1)
+        pixels = images.float() * std + mean
+        patches = pixels.unfold(2, patch_size, patch_size).unfold(3, patch_size, patch_size)
+        patches = patches.permute(0, 2, 3, 1, 4, 5).flatten(3).flatten(1, 2)
+        uniform = patches.std(dim=-1) < self.patch_drop_threshold
+        white = patches.amin(dim=-1) > self.patch_drop_white_level
+        return uniform | white
+
+    def forward_content_patches(self, images):
+        """Run the ViT on the content patches only, returning one feature tensor per image."""
+        vision_model = self.vision_tower.vision_model
+        dtype = images.dtype
+        images = images.to(device=self.device, dtype=self.dtype)
+
+        class_embeds, patch_embeds = self.embed_patches(images)
+        B, N, C = patch_embeds.shape
+
+        keep = ~self.background_patch_mask(images)
+        keep[keep.sum(dim=1) == 0, 0] = True
+        lengths = keep.sum(dim=1)
+        max_len = int(lengths.max()) + 1
+
+        # compact the kept patches (they already carry their position embeddings) to the front
+        hidden_states = patch_embeds.new_zeros(B, max_len, C)
+        hidden_states[:, 0] = class_embeds
+        batch_idx, patch_idx = keep.nonzero(as_tuple=True)
+        slot_idx = keep.cumsum(dim=1)[batch_idx, patch_idx]
+        hidden_states[batch_idx, slot_idx] = patch_embeds[batch_idx, patch_idx]
+
+        valid = torch.arange(max_len, device=self.device)[None] <= lengths[:, None]
+        attention_mask = torch.zeros(B, 1, max_len, max_len, device=self.device, dtype=self.dtype)
+        attention_mask.masked_fill_(~valid[:, None, None, :], torch.finfo(self.dtype).min)
+
+        hidden_states = vision_model.pre_layrnorm(hidden_states)
+        encoder_outs = vision_model.encoder(inputs_embeds=hidden_states, attention_mask=attention_mask,
+                                            output_hidden_states=not self.is_truncated)
+        image_features = self.feature_select(encoder_outs).to(dtype)
+
+        offset = 0 if self.select_feature == 'patch' else 1
+        self.last_drop_report = [{"tokens": N, "kept": int(n), "dropped": N - int(n)} for n in lengths]
+        self.patch_drop_stats["images"] += B
+        self.patch_drop_stats["tokens"] += B * N
+        self.patch_drop_stats["dropped"] += B * N - int(lengths.sum())
+        return [image_features[i, :int(n) + offset] for i, n in enumerate(lengths)]
+
     @property
     def dummy_feature(self):
         return torch.zeros(1, self.hidden_size, device=self.device, dtype=self.dtype)
@@ -0,0 +1,73 @@
+import torch
+
+
+def bipartite_soft_matching(x, size, r):
+    """Merge the r most similar token pairs of x (ToMe-style bipartite soft matching).
+
+    Tokens are split into two alternating sets A and B, every token in A is matched to
+    its most similar token in B, and the r best matched A tokens are averaged into their
+    partners (weighted by how many patches each token already represents). The output
+    keeps the original raster order of the surviving tokens.
+
+    Args:
+        x (torch.Tensor): Token features of shape (B, N, C).
+        size (torch.Tensor): Number of patches represented by each token, shape (B, N, 1).
+        r (int): Number of tokens to remove, at most ceil(N / 2).
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The merged features (B, N - r, C) and sizes.
+    """
+    B, N, C = x.shape
+    r = min(r, (N + 1) // 2)
+    if r <= 0 or N < 2:
+        return x, size
+
+    with torch.no_grad():
+        metric = x.float()
+        metric = metric / metric.norm(dim=-1, keepdim=True).clamp_min(1e-6)
+        a, b = metric[:, ::2], metric[:, 1::2]
+        scores = a @ b.transpose(-1, -2)
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[:, r:]
+        src_idx = edge_idx[:, :r]
+        dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)
+
+        positions = torch.arange(N, device=x.device).expand(B, N)
+        unm_pos = positions[:, ::2].gather(dim=1, index=unm_idx[..., 0])
+        dst_pos = positions[:, 1::2]
+        order = torch.cat([unm_pos, dst_pos], dim=1).argsort(dim=1)
+
+    def merge(t):
+        src, dst = t[:, ::2], t[:, 1::2]
+        c = t.shape[-1]
+        unm = src.gather(dim=1, index=unm_idx.expand(-1, -1, c))
+        src = src.gather(dim=1, index=src_idx.expand(-1, -1, c))
+        dst = dst.scatter_reduce(1, dst_idx.expand(-1, -1, c), src, reduce='sum')
+        merged = torch.cat([unm, dst], dim=1)
+        return merged.gather(dim=1, index=order[..., None].expand(-1, -1, c))
+
+    x = merge(x.float() * size)
+    size = merge(size)
+    return x / size, size
+
+
+def merge_visual_tokens(image_features, target_tokens):
+    """Reduce the patch tokens of each image to `target_tokens` by repeated soft matching.
+
+    Each round can at most halve the sequence, so budgets below N / 2 (e.g. 1296 -> 144)
+    take several rounds. Near-uniform background patches are the most similar pairs and
+    are therefore merged first.
+    """
+    if isinstance(image_features, (list, tuple)):
+        return [merge_visual_tokens(x.unsqueeze(0), target_tokens)[0] for x in image_features]
+    if target_tokens is None or image_features.shape[1] <= target_tokens:
+        return image_features
+
+    dtype = image_features.dtype
+    x = image_features
+    size = torch.ones_like(x[..., :1], dtype=torch.float32)
+    while x.shape[1] > target_tokens:
+        x, size = bipartite_soft_matching(x, size, x.shape[1] - target_tokens)
+    return x.to(dtype)
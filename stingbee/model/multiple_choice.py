@@ -0,0 +1,84 @@
+import re
+
+import torch
+
+from .stingbee_arch import position_ids_from_attention_mask
+
+
+# "A. gun", "(B) knife", "C) scissors" or "D: none" at the start of a line
+OPTION_PATTERN = re.compile(r'^\s*\(?([A-Z])[.):]\s', re.MULTILINE)
+
+
+def parse_options(question, default="ABCD"):
+    """Option letters listed in a multiple-choice question, `default` if none are found."""
+    letters = list(dict.fromkeys(OPTION_PATTERN.findall(question)))
+    return letters or list(default)
+
+
+def option_token_ids(tokenizer, letter):
+    """Tokens an answer `letter` can start with: "▁A" right after "ASSISTANT:", or a bare "A"."""
+    ids = {tokenizer.convert_tokens_to_ids(token) for token in ("▁" + letter, letter)}
+    ids.discard(None)
+    ids.discard(tokenizer.unk_token_id)
+    if not ids:
+        raise ValueError(f"Option letter {letter!r} is not a token of the vocabulary.")
+    return sorted(ids)
+
+
+def content_free_question(letters):
+    """The question with every field replaced by "N/A", for `option_prior`."""
+    return "N/A\n" + "\n".join(f"{letter}. N/A" for letter in letters)
+
+
+def option_prior(model, tokenizer, input_ids, letters):
+    """Probabilities the model gives `letters` for a content-free prompt `input_ids` (1-D).
+
+    Contextual calibration (Zhao et al., 2021): the bias of the model towards some letters,
+    whatever the question, is divided out of the scores of real questions by `score_options`.
+    """
+    input_ids = input_ids.reshape(1, -1)
+    _, probabilities, _ = score_options(model, tokenizer, input_ids, torch.ones_like(input_ids), [letters])
+    return probabilities[0]
+
+
+@torch.inference_mode()
+def score_options(model, tokenizer, input_ids, attention_mask, options, images=None, image_features=None, priors=None):
+    """Answer multiple-choice questions from one prefill, without decoding.
+
+    The next-token log-probabilities of each option letter (summed over its tokenizations)
+    are renormalized over the options of the row, so the probabilities of a row add up to 1.
+    These are the model's raw preferences; with `priors` (from `option_prior`, one dict per
+    row) each letter is first divided by its content-free probability, which calibrates them.
+
+    Args:
+        model: A StingBee causal LM.
+        input_ids (torch.LongTensor): Left-padded prompts (B, L), as passed to `generate`.
+        attention_mask (torch.Tensor): Their (B, L) mask.
+        options (List[List[str]]): Option letters of each row, e.g. from `parse_options`.
+        priors (List[Dict[str, float]]): Optional content-free probabilities of each row's letters.
+
+    Returns:
+        Tuple[List[str], List[Dict[str, float]], List[float]]: The most likely letter of each
+        row, the probability of every option, and the probability mass the model put on the
+        option letters at all (low when it would have answered something else).
+    """
+    _, attention_mask, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+        input_ids, attention_mask, None, None, images, image_features)
+    hidden_states = model.get_model()(input_ids=input_ids if inputs_embeds is None else None, inputs_embeds=inputs_embeds,
+                                      attention_mask=attention_mask, position_ids=position_ids_from_attention_mask(attention_mask),
+                                      use_cache=False, return_dict=True).last_hidden_state
+    # prompts are left-padded, so every row ends at the last position
+    logprobs = torch.log_softmax(model.lm_head(hidden_states[:, -1, :]).float(), dim=-1)
+
+    predictions, probabilities, option_mass = [], [], []
+    for row, letters in enumerate(options):
+        if not letters:
+            raise ValueError(f"Row {row} has no options to score.")
+        scores = torch.stack([logprobs[row, option_token_ids(tokenizer, letter)].logsumexp(dim=0) for letter in letters])
+        option_mass.append(float(scores.logsumexp(dim=0).exp()))
+        if priors is not None:
+            scores = scores - torch.tensor([priors[row][letter] for letter in letters], device=scores.device).clamp(min=1e-12).log()
+        probs = torch.softmax(scores, dim=0).tolist()
+        predictions.append(letters[max(range(len(letters)), key=probs.__getitem__)])
+        probabilities.append(dict(zip(letters, probs)))
+    return predictions, probabilities, option_mass
@@ -0,0 +1,111 @@
+import copy
+import os
+import warnings
+
+import torch
+import torch.nn as nn
+
+from stingbee.parity import report, tensor_parity
+
+
+class VisionEncoderForExport(nn.Module):
+    """CLIP tower and mm_projector as one module: pixels (B, 3, 504, 504) -> projected image tokens."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.vision_tower = model.get_vision_tower()
+        self.mm_projector = model.get_model().mm_projector
+
+    def forward(self, pixel_values):
+        image_forward_outs = self.vision_tower.vision_tower(pixel_values, output_hidden_states=not self.vision_tower.is_truncated)
+        image_features = self.vision_tower.feature_select(image_forward_outs)
+        return self.mm_projector(image_features)
+
+
+def fp32_vision_encoder(model):
+    """A truncated fp32 CPU copy of the tower and projector; the modules of `model` are left as they are."""
+    encoder = copy.deepcopy(VisionEncoderForExport(model))
+    if not encoder.vision_tower.is_truncated:
+        encoder.vision_tower.truncate_to_select_layer()
+    return encoder.to(device='cpu', dtype=torch.float32).eval()
+
+
+def export_vision_onnx(model, onnx_path, opset_version=17):
+    """Export the (truncated) vision tower plus projector of `model` to a single fp32 ONNX graph."""
+    encoder = fp32_vision_encoder(model)
+    image_size = encoder.vision_tower.native_image_size
+    dummy = torch.zeros(1, 3, image_size, image_size)
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            (dummy,),
+            onnx_path,
+            input_names=['pixel_values'],
+            output_names=['image_features'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'image_features': {0: 'batch'}},
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    return onnx_path
+
+
+def quantize_vision_onnx(onnx_path, quantized_path):
+    """Dynamic int8 weight quantization of an exported vision graph."""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+class OnnxVisionEncoder:
+    """Runs an exported vision graph with onnxruntime on CPU, standing in for the tower and projector."""
+
+    def __init__(self, onnx_path, num_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.onnx_path = onnx_path
+        # identifies the exported graph (fp32 or int8) for the image embedding cache
+        self.signature = f"onnx:{os.path.abspath(onnx_path)}:{os.path.getsize(onnx_path)}:{int(os.path.getmtime(onnx_path))}"
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.image_size = self.session.get_inputs()[0].shape[-1]
+
+    def supports(self, images):
+        return torch.is_tensor(images) and images.ndim == 4 and images.shape[-1] == images.shape[-2] == self.image_size
+
+    def __call__(self, images):
+        pixel_values = images.detach().to(device='cpu', dtype=torch.float32).numpy()
+        image_features = self.session.run(None, {'pixel_values': pixel_values})[0]
+        return torch.from_numpy(image_features)
+
+
+@torch.no_grad()
+def check_onnx_parity(model, encoder, images, min_cosine=0.99):
+    """Compare the onnxruntime output with the PyTorch path on the same pixels.
+
+    Args:
+        images (torch.Tensor): (B, 3, H, W) preprocessed scans at the graph's input size;
+            the reference runs on an fp32 CPU copy of the tower, like the exported graph.
+
+    Returns:
+        Tuple[bool, dict]: Whether the mean per-token cosine similarity reaches `min_cosine`,
+        and the measured statistics.
+    """
+    images = images.to(device='cpu', dtype=torch.float32)
+    reference = fp32_vision_encoder(model)(images)
+    return tensor_parity(reference, encoder(images), min_cosine=min_cosine)
+
+
+def attach_onnx_vision_encoder(model, onnx_path, parity_images=None, parity_check=True, num_threads=None):
+    """Route `encode_images` through onnxruntime when the parity check on `parity_images` passes."""
+    if parity_check and parity_images is None:
+        raise ValueError("The ONNX parity check needs preprocessed images; pass parity_images or parity_check=False.")
+    encoder = OnnxVisionEncoder(onnx_path, num_threads=num_threads)
+    if parity_check:
+        passed, stats = check_onnx_parity(model, encoder, parity_images)
+        if not report("ONNX vision encoder parity", passed, stats):
+            warnings.warn(f"ONNX vision encoder {onnx_path} does not match the PyTorch path; keeping PyTorch.")
+            return None
+    model.onnx_vision_encoder = encoder
+    return encoder
@@ -0,0 +1,204 @@
+"""
+Paged KV cache for decoding with StingBee Llama models.
+
+Keys and values live in one preallocated pool of fixed-size blocks. Each sequence owns a
+block table listing its blocks in order, so a sequence grows by taking a block off the free
+list instead of re-concatenating its whole cache, and a finished sequence hands its blocks
+back for the next request.
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+from transformers.models.llama.modeling_llama import apply_rotary_pos_emb, repeat_kv
+
+
+class BlockAllocator:
+    """Free list over `num_blocks` block ids."""
+
+    def __init__(self, num_blocks):
+        self.num_blocks = num_blocks
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def allocate(self):
+        if not self.free_blocks:
+            raise RuntimeError("The paged KV cache is out of blocks.")
+        return self.free_blocks.pop()
+
+    def free(self, blocks):
+        self.free_blocks.extend(reversed(blocks))
+
+
+class PagedKVCache:
+    """Block pool holding the keys and values of all running sequences.
+
+    Args:
+        num_layers, num_kv_heads, head_dim (int): Shape of the model's attention.
+        num_blocks (int): Blocks in the pool.
+        block_size (int): Tokens per block.
+    """
+
+    def __init__(self, num_layers, num_kv_heads, head_dim, num_blocks, block_size=16,
+                 dtype=torch.float16, device="cuda"):
+        self.block_size = block_size
+        shape = (num_layers, num_blocks * block_size, num_kv_heads, head_dim)
+        self.key_pages = torch.zeros(shape, dtype=dtype, device=device)
+        self.value_pages = torch.zeros(shape, dtype=dtype, device=device)
+        self.allocator = BlockAllocator(num_blocks)
+        self.block_tables = {}
+        self.lengths = {}
+
+    @classmethod
+    def for_model(cls, model, max_bytes, block_size=16):
+        """A pool of as many blocks as fit in `max_bytes` for `model`."""
+        config = model.config
+        num_kv_heads = getattr(config, "num_key_value_heads", config.num_attention_heads)
+        head_dim = config.hidden_size // config.num_attention_heads
+        dtype = model.get_model().embed_tokens.weight.dtype
+        block_bytes = 2 * config.num_hidden_layers * block_size * num_kv_heads * head_dim * torch.finfo(dtype).bits // 8
+        return cls(config.num_hidden_layers, num_kv_heads, head_dim, max(1, int(max_bytes // block_bytes)),
+                   block_size, dtype=dtype, device=model.device)
+
+    @property
+    def num_blocks(self):
+        return self.allocator.num_blocks
+
+    @property
+    def num_free_blocks(self):
+        return self.allocator.num_free_blocks
+
+    def blocks_needed(self, num_tokens):
+        return math.ceil(num_tokens / self.block_size)
+
+    def add_sequence(self, seq_id):
+        self.block_tables[seq_id] = []
+        self.lengths[seq_id] = 0
+
+    def free_sequence(self, seq_id):
+        self.allocator.free(self.block_tables.pop(seq_id))
+        del self.lengths[seq_id]
+
+    def reserve(self, seq_ids, num_tokens):
+        """Grow each sequence by `num_tokens` positions.
+
+        Returns:
+            torch.LongTensor: (B, num_tokens) positions of the new tokens in their sequences.
+        """
+        needed = sum(self.blocks_needed(self.lengths[seq_id] + num_tokens) - len(self.block_tables[seq_id]) for seq_id in seq_ids)
+        if needed > self.num_free_blocks:
+            # checked up front so a failed step leaves every table as it was
+            raise RuntimeError("The paged KV cache is out of blocks.")
+        positions = []
+        for seq_id in seq_ids:
+            start = self.lengths[seq_id]
+            table = self.block_tables[seq_id]
+            while len(table) < self.blocks_needed(start + num_tokens):
+                table.append(self.allocator.allocate())
+            self.lengths[seq_id] = start + num_tokens
+            positions.append(range(start, start + num_tokens))
+        return torch.tensor(positions, dtype=torch.long, device=self.key_pages.device)
+
+    def block_table(self, seq_ids):
+        """(B, max_blocks) block tables, padded with block 0 (masked by the lengths)."""
+        width = max(len(self.block_tables[seq_id]) for seq_id in seq_ids)
+        return torch.tensor([self.block_tables[seq_id] + [0] * (width - len(self.block_tables[seq_id])) for seq_id in seq_ids],
+                            dtype=torch.long, device=self.key_pages.device)
+
+    def slots(self, block_table, positions):
+        """Rows of the pool for `positions` (B, T) of sequences with `block_table`."""
+        return block_table.gather(1, positions // self.block_size) * self.block_size + positions % self.block_size
+
+    def write(self, layer, slots, key_states, value_states):
+        """Store (B, H, T, D) keys and values at `slots` (B, T)."""
+        self.key_pages[layer][slots.flatten()] = key_states.transpose(1, 2).flatten(0, 1)
+        self.value_pages[layer][slots.flatten()] = value_states.transpose(1, 2).flatten(0, 1)
+
+    def read(self, layer, block_table):
+        """Keys and values of whole blocks as (B, H, max_blocks * block_size, D)."""
+        slots = (block_table[:, :, None] * self.block_size
+                 + torch.arange(self.block_size, device=block_table.device)).flatten(1)
+        return self.key_pages[layer][slots].transpose(1, 2), self.value_pages[layer][slots].transpose(1, 2)
+
+
+def _paged_attention(attn, hidden_states, positions, cache, layer, block_table, slots):
+    bsz, q_len, _ = hidden_states.size()
+    query_states = attn.q_proj(hidden_states).view(bsz, q_len, attn.num_heads, attn.head_dim).transpose(1, 2)
+    key_states = attn.k_proj(hidden_states).view(bsz, q_len, attn.num_key_value_heads, attn.head_dim).transpose(1, 2)
+    value_states = attn.v_proj(hidden_states).view(bsz, q_len, attn.num_key_value_heads, attn.head_dim).transpose(1, 2)
+
+    cos, sin = attn.rotary_emb(value_states, seq_len=int(positions.max()) + 1)
+    query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, positions)
+    cache.write(layer, slots, key_states, value_states)
+
+    key_states, value_states = cache.read(layer, block_table)
+    key_states = repeat_kv(key_states, attn.num_key_value_groups)
+    value_states = repeat_kv(value_states, attn.num_key_value_groups)
+    # causal and per-sequence length in one: a query sees the keys up to its own position
+    key_positions = torch.arange(key_states.shape[2], device=positions.device)
+    attn_mask = key_positions[None, None, None, :] <= positions[:, None, :, None]
+    attn_output = F.scaled_dot_product_attention(query_states, key_states, value_states, attn_mask=attn_mask)
+    return attn.o_proj(attn_output.transpose(1, 2).reshape(bsz, q_len, attn.hidden_size))
+
+
+@torch.inference_mode()
+def paged_forward(model, cache, seq_ids, input_ids=None, inputs_embeds=None):
+    """Run new tokens of `seq_ids` through the LLM, reading and extending their pages.
+
+    All sequences get the same number of new tokens: a single-sequence prefill of its whole
+    prompt, or one token each when decoding a batch.
+
+    Args:
+        model: A StingBee causal LM.
+        cache (PagedKVCache): Holds every sequence in `seq_ids`.
+        input_ids (torch.LongTensor): (B, T) text tokens, or
+        inputs_embeds (torch.FloatTensor): (B, T, C) embeddings, e.g. with the image spliced in.
+
+    Returns:
+        torch.FloatTensor: (B, vocab) logits of the last new token of each sequence.
+    """
+    llama = model.get_model()
+    hidden_states = llama.embed_tokens(input_ids) if inputs_embeds is None else inputs_embeds
+    positions = cache.reserve(seq_ids, hidden_states.shape[1])
+    block_table = cache.block_table(seq_ids)
+    slots = cache.slots(block_table, positions)
+    for layer, decoder_layer in enumerate(llama.layers):
+        residual = hidden_states
+        hidden_states = _paged_attention(decoder_layer.self_attn, decoder_layer.input_layernorm(hidden_states),
+                                         positions, cache, layer, block_table, slots)
+        hidden_states = residual + hidden_states
+        residual = hidden_states
+        hidden_states = residual + decoder_layer.mlp(decoder_layer.post_attention_layernorm(hidden_states))
+    return model.lm_head(llama.norm(hidden_states[:, -1, :]))
+
+
+@torch.inference_mode()
+def splice_prompt(model, input_ids, images=None):
+    """Model inputs of the 1-D prompt `input_ids` with its images spliced in.
+
+    The length of the result is what the sequence takes in the cache, whatever the
+    vision path made of the images (a grid of tiles, merged tokens, dropped patches).
+
+    Returns:
+        Dict[str, torch.Tensor]: `input_ids` (1, T) for a text-only prompt, otherwise `inputs_embeds` (1, T, C).
+    """
+    input_ids = input_ids[None]
+    _, _, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+        input_ids, torch.ones_like(input_ids), None, None, images)
+    if inputs_embeds is None:
+        return {"input_ids": input_ids}
+    return {"inputs_embeds": inputs_embeds}
+
+
+@torch.inference_mode()
+def paged_prefill(model, cache, seq_id, prompt):
+    """Prefill a new sequence from `prompt`, as returned by `splice_prompt`.
+
+    Returns:
+        torch.FloatTensor: (1, vocab) logits of the token after the prompt.
+    """
+    cache.add_sequence(seq_id)
+    return paged_forward(model, cache, [seq_id], **prompt)
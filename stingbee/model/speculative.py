@@ -0,0 +1,154 @@
+import torch
+
+from stingbee.constants import IMAGE_TOKEN_INDEX
+from .stingbee_arch import position_ids_from_attention_mask
+
+
+def prompt_lookup_draft(tokens, num_draft_tokens, max_ngram_size=3):
+    """Tokens that followed the latest earlier occurrence of the sequence's last n-gram.
+
+    Grounding and referring answers repeat their own `<p>class</p> {<x><y>...}` syntax,
+    so the tail of the answer so far is usually found earlier in it or in the prompt.
+
+    Args:
+        tokens (torch.LongTensor): 1-D prompt and output so far.
+
+    Returns:
+        List[int]: Up to `num_draft_tokens` draft tokens, empty if no n-gram matched.
+    """
+    for n in range(max_ngram_size, 0, -1):
+        if tokens.shape[0] <= n:
+            continue
+        # windows ending before the last token, so the tail does not match itself
+        matches = (tokens[:-1].unfold(0, n, 1) == tokens[-n:]).all(dim=1).nonzero(as_tuple=True)[0]
+        if matches.numel() == 0:
+            continue
+        start = int(matches[-1]) + n
+        draft = tokens[start:start + num_draft_tokens].tolist()
+        if IMAGE_TOKEN_INDEX in draft:
+            draft = draft[:draft.index(IMAGE_TOKEN_INDEX)]
+        if draft:
+            return draft
+    return []
+
+
+def _trim_past(past_key_values, length):
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in past_key_values)
+
+
+class DraftModelProposer:
+    """Greedy drafts from a small causal LM sharing the tokenizer.
+
+    The draft model does not see the images: image tokens are masked out of its input.
+    Its cache is kept between rounds and cut back to what the accepted tokens still match.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.past_key_values = None
+        self.cached_ids = None
+
+    def propose(self, sequences, attention_mask, num_draft_tokens):
+        """(B, num_draft_tokens) drafts following `sequences`, with `attention_mask` its (B, L) mask."""
+        input_ids = sequences.clamp(min=0)
+        attention_mask = attention_mask.long() * (sequences != IMAGE_TOKEN_INDEX).long()
+        keep = 0
+        if self.cached_ids is not None:
+            n = min(self.cached_ids.shape[1], input_ids.shape[1])
+            mismatch = (~(self.cached_ids[:, :n] == input_ids[:, :n]).all(dim=0)).nonzero(as_tuple=True)[0]
+            keep = int(mismatch[0]) if mismatch.numel() > 0 else n
+        # at least one token is fed to get the next logits
+        keep = min(keep, input_ids.shape[1] - 1)
+        past_key_values = _trim_past(self.past_key_values, keep) if keep > 0 else None
+
+        outputs = self.model(input_ids=input_ids[:, keep:], attention_mask=attention_mask,
+                             position_ids=position_ids_from_attention_mask(attention_mask)[:, keep:],
+                             past_key_values=past_key_values, use_cache=True, return_dict=True)
+        drafts = []
+        for i in range(num_draft_tokens):
+            next_tokens = outputs.logits[:, -1, :].argmax(dim=-1)
+            drafts.append(next_tokens)
+            if i == num_draft_tokens - 1:
+                break
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=1)
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=1)
+            outputs = self.model(input_ids=next_tokens[:, None], attention_mask=attention_mask,
+                                 position_ids=position_ids_from_attention_mask(attention_mask)[:, -1:],
+                                 past_key_values=outputs.past_key_values, use_cache=True, return_dict=True)
+        self.past_key_values, self.cached_ids = outputs.past_key_values, input_ids
+        return torch.stack(drafts, dim=1)
+
+
+@torch.inference_mode()
+def generate_speculative(model, input_ids, attention_mask, images=None, image_features=None, max_new_tokens=256,
+                         num_draft_tokens=8, max_ngram_size=3, draft_model=None, pad_token_id=0, eos_token_id=None,
+                         stopping_criteria=None, logits_processor=None):
+    """Greedy decoding that verifies drafted tokens in one forward pass.
+
+    Each round drafts up to `num_draft_tokens` per row, from prompt lookup or, for rows
+    without an n-gram match, from `draft_model`. The model scores the last token and the
+    drafts together; tokens are then taken one by one exactly as greedy `generate` would
+    pick them (logits processors and stopping criteria included) for as long as every
+    unfinished row's pick equals the draft that was fed after it. The cache is cut back
+    to the accepted tokens, so the output matches `generate` with `do_sample=False`.
+
+    Args:
+        model: A StingBee causal LM.
+        input_ids (torch.LongTensor): Left-padded prompts (B, L), as passed to `generate`.
+        attention_mask (torch.Tensor): Their (B, L) mask.
+        draft_model: Optional causal LM with the same tokenizer.
+        stopping_criteria, logits_processor: Lists of callables as taken by `generate`.
+
+    Returns:
+        torch.LongTensor: Prompts followed by the generated tokens, like `generate` returns.
+    """
+    proposer = DraftModelProposer(draft_model) if draft_model is not None else None
+    outputs = model(input_ids=input_ids, attention_mask=attention_mask, images=images, image_features=image_features,
+                    use_cache=True, return_dict=True)
+    # the mask of the spliced sequence, which the cache follows
+    past_key_values, full_mask = outputs.past_key_values, outputs.attention_mask
+    sequences = input_ids
+    finished = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    def append(scores):
+        nonlocal sequences
+        for processor in logits_processor or []:
+            scores = processor(sequences, scores)
+        next_tokens = scores.argmax(dim=-1).masked_fill(finished, pad_token_id)
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=1)
+        if eos_token_id is not None:
+            finished.logical_or_(next_tokens == eos_token_id)
+        stop = bool(finished.all()) or any(criteria(sequences, scores) for criteria in stopping_criteria or [])
+        return next_tokens, stop
+
+    next_tokens, stop = append(outputs.logits[:, -1, :])
+    num_new = 1
+    while not stop and num_new < max_new_tokens:
+        k = min(num_draft_tokens, max_new_tokens - num_new - 1)
+        drafts = torch.full((sequences.shape[0], k), pad_token_id, dtype=sequences.dtype, device=sequences.device)
+        if k > 0:
+            rows = sequences.cpu()
+            missing = []
+            for row in range(rows.shape[0]):
+                draft = prompt_lookup_draft(rows[row], k, max_ngram_size)
+                drafts[row, :len(draft)] = torch.tensor(draft, dtype=drafts.dtype)
+                if not draft:
+                    missing.append(row)
+            if proposer is not None and missing:
+                text_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], num_new))], dim=1)
+                model_drafts = proposer.propose(sequences, text_mask, k)
+                drafts[missing] = model_drafts[missing]
+
+        full_mask = torch.cat([full_mask, full_mask.new_ones((full_mask.shape[0], k + 1))], dim=1)
+        outputs = model(input_ids=torch.cat([next_tokens[:, None], drafts], dim=1), attention_mask=full_mask,
+                        past_key_values=past_key_values, use_cache=True, return_dict=True)
+        for j in range(k + 1):
+            next_tokens, stop = append(outputs.logits[:, j, :])
+            num_new += 1
+            # the logits at j + 1 are only valid if the token fed there is the one just picked
+            if stop or j == k or not ((next_tokens == drafts[:, j]) | finished).all():
+                break
+        # keep the cache of the accepted tokens; the last pick is fed next round
+        length = full_mask.shape[1] - (k - j)
+        past_key_values, full_mask = _trim_past(outputs.past_key_values, length), full_mask[:, :length]
+    return sequences
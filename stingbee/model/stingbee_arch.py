@@ -20,10 +20,27 @@ import torch.nn as nn
 
 from .multimodal_encoder.builder import build_vision_tower
 from .multimodal_projector.builder import build_vision_projector
+from .multimodal_encoder.token_merge import merge_visual_tokens
+from .embedding_cache import vision_signature
 
 from stingbee.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 
 
+def position_ids_from_attention_mask(attention_mask):
+    """Positions that skip padding, so a padded row is numbered as it would be alone."""
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    return position_ids
+
+
+def split_by_sizes(items, sizes):
+    chunks, start = [], 0
+    for size in sizes:
+        chunks.append(items[start:start + size])
+        start += size
+    return chunks
+
+
 class StingBeeMetaModel:
 
     def __init__(self, config):
@@ -99,127 +116,127 @@ class StingBeeMetaForCausalLM(ABC):
         return self.get_model().get_vision_tower()
 
     def encode_images(self, images):
+        cache = getattr(self, 'image_embedding_cache', None)
+        if cache is not None and not self.training:
+            return cache.encode(images, self._encode_images, vision_signature(self), self.device, self.dtype)
+        return self._encode_images(images)
+
+    def _encode_images(self, images):
+        onnx_encoder = getattr(self, 'onnx_vision_encoder', None)
+        if onnx_encoder is not None and onnx_encoder.supports(images) and not getattr(self.config, 'mm_token_budget', None) \
+                and self.get_vision_tower().patch_drop_threshold is None:
+            # the exported graph already includes the projector
+            return onnx_encoder(images).to(device=self.device, dtype=self.dtype)
         image_features = self.get_model().get_vision_tower()(images)
+        token_budget = getattr(self.config, 'mm_token_budget', None)
+        if token_budget:
+            # merge similar patches down to the budget before they reach the LLM
+            image_features = merge_visual_tokens(image_features, token_budget)
+        if type(image_features) is list:
+            # per-image features of different lengths share one projector call
+            split_sizes = [x.shape[0] for x in image_features]
+            image_features = self.get_model().mm_projector(torch.cat(image_features, dim=0))
+            return list(torch.split(image_features, split_sizes, dim=0))
         image_features = self.get_model().mm_projector(image_features)
         return image_features
 
     def prepare_inputs_labels_for_multimodal(
-        self, input_ids, attention_mask, past_key_values, labels, images
+        self, input_ids, attention_mask, past_key_values, labels, images, image_features=None
     ):
         vision_tower = self.get_vision_tower()
-        
-        if vision_tower is None or images is None or input_ids.shape[1] == 1:
-            if past_key_values is not None and vision_tower is not None and images is not None and input_ids.shape[1] == 1:
-                attention_mask = torch.ones((attention_mask.shape[0], past_key_values[-1][-1].shape[-2] + 1), dtype=attention_mask.dtype, device=attention_mask.device)
+        has_images = images is not None or image_features is not None
+
+        if vision_tower is None or not has_images or input_ids.shape[1] == 1:
+            if past_key_values is not None and vision_tower is not None and has_images and input_ids.shape[1] == 1:
+                target_len = past_key_values[-1][-1].shape[-2] + 1
+                # `generate` carries the mask of the spliced sequence (see `_update_model_kwargs_for_generation`)
+                if attention_mask is None or attention_mask.shape[1] != target_len:
+                    attention_mask = torch.ones((input_ids.shape[0], target_len), dtype=torch.long if attention_mask is None else attention_mask.dtype, device=input_ids.device)
             return input_ids, attention_mask, past_key_values, None, labels
 
-        if type(images) is list or images.ndim == 5:
-            concat_images = torch.cat([image for image in images], dim=0)
-            image_features = self.encode_images(concat_images)
+        if image_features is not None:
+            # precomputed by `encode_images`, e.g. while the previous batch was decoding
+            pass
+        elif type(images) is list or images.ndim == 5:
+            images = [image if image.ndim == 4 else image.unsqueeze(0) for image in images]
             split_sizes = [image.shape[0] for image in images]
-            image_features = torch.split(image_features, split_sizes, dim=0)
-            image_features = [x.flatten(0, 1) for x in image_features]
+            # the vision tower buckets the flattened list by shape, so mixed
+            # resolutions still run batched
+            image_features = list(self.encode_images([x for image in images for x in image]))
+            image_features = [torch.cat(x, dim=0) for x in split_by_sizes(image_features, split_sizes)]
         else:
             image_features = self.encode_images(images)
 
-        new_input_embeds = []
-        new_labels = [] if labels is not None else None
-        cur_image_idx = 0
-        for batch_idx, cur_input_ids in enumerate(input_ids):
-            if (cur_input_ids == IMAGE_TOKEN_INDEX).sum() == 0:
-                # multimodal LLM, but the current sample is not multimodal
-                # FIXME: this is a hacky fix, for deepspeed zero3 to work
-                half_len = cur_input_ids.shape[0] // 2
-                cur_image_features = image_features[cur_image_idx]
-                cur_input_embeds_1 = self.get_model().embed_tokens(cur_input_ids[:half_len])
-                cur_input_embeds_2 = self.get_model().embed_tokens(cur_input_ids[half_len:])
-                cur_input_embeds = torch.cat([cur_input_embeds_1, cur_image_features[0:0], cur_input_embeds_2], dim=0)
-                new_input_embeds.append(cur_input_embeds)
-                if labels is not None:
-                    new_labels.append(labels[batch_idx])
-                cur_image_idx += 1
-                continue
-            image_token_indices = torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0]
-            cur_new_input_embeds = []
-            if labels is not None:
-                cur_labels = labels[batch_idx]
-                cur_new_labels = []
-                assert cur_labels.shape == cur_input_ids.shape
-            while image_token_indices.numel() > 0:
-                cur_image_features = image_features[cur_image_idx]
-                image_token_start = image_token_indices[0]
-                if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[:image_token_start-1]).detach())
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[image_token_start-1:image_token_start]))
-                    cur_new_input_embeds.append(cur_image_features)
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[image_token_start+1:image_token_start+2]))
-                    if labels is not None:
-                        cur_new_labels.append(cur_labels[:image_token_start])
-                        cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=labels.device, dtype=labels.dtype))
-                        cur_new_labels.append(cur_labels[image_token_start:image_token_start+1])
-                        cur_labels = cur_labels[image_token_start+2:]
-                else:
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[:image_token_start]))
-                    cur_new_input_embeds.append(cur_image_features)
-                    if labels is not None:
-                        cur_new_labels.append(cur_labels[:image_token_start])
-                        cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=labels.device, dtype=labels.dtype))
-                        cur_labels = cur_labels[image_token_start+1:]
-                cur_image_idx += 1
-                if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
-                    cur_input_ids = cur_input_ids[image_token_start+2:]
-                else:
-                    cur_input_ids = cur_input_ids[image_token_start+1:]
-                image_token_indices = torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0]
-            if cur_input_ids.numel() > 0:
-                if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids).detach())
-                else:
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids))
-                if labels is not None:
-                    cur_new_labels.append(cur_labels)
-            cur_new_input_embeds = [x.to(device=self.device) for x in cur_new_input_embeds]
-            cur_new_input_embeds = torch.cat(cur_new_input_embeds, dim=0)
-            new_input_embeds.append(cur_new_input_embeds)
-            if labels is not None:
-                cur_new_labels = torch.cat(cur_new_labels, dim=0)
-                new_labels.append(cur_new_labels)
-
-        if any(x.shape != new_input_embeds[0].shape for x in new_input_embeds):
-            max_len = max(x.shape[0] for x in new_input_embeds)
-
-            new_input_embeds_align = []
-            for cur_new_embed in new_input_embeds:
-                cur_new_embed = torch.cat((cur_new_embed, torch.zeros((max_len - cur_new_embed.shape[0], cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device)), dim=0)
-                new_input_embeds_align.append(cur_new_embed)
-            new_input_embeds = torch.stack(new_input_embeds_align, dim=0)
-
-            if labels is not None:
-                new_labels_align = []
-                _new_labels = new_labels
-                for cur_new_label in new_labels:
-                    cur_new_label = torch.cat((cur_new_label, torch.full((max_len - cur_new_label.shape[0],), IGNORE_INDEX, dtype=cur_new_label.dtype, device=cur_new_label.device)), dim=0)
-                    new_labels_align.append(cur_new_label)
-                new_labels = torch.stack(new_labels_align, dim=0)
-
-            if attention_mask is not None:
-                new_attention_mask = []
-                for cur_attention_mask, cur_new_labels, cur_new_labels_align in zip(attention_mask, _new_labels, new_labels):
-                    new_attn_mask_pad_left = torch.full((cur_new_labels.shape[0] - labels.shape[1],), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                    new_attn_mask_pad_right = torch.full((cur_new_labels_align.shape[0] - cur_new_labels.shape[0],), False, dtype=attention_mask.dtype, device=attention_mask.device)
-                    cur_new_attention_mask = torch.cat((new_attn_mask_pad_left, cur_attention_mask, new_attn_mask_pad_right), dim=0)
-                    new_attention_mask.append(cur_new_attention_mask)
-                attention_mask = torch.stack(new_attention_mask, dim=0)
-                assert attention_mask.shape == new_labels.shape
+        batch_size = input_ids.shape[0]
+        device = input_ids.device
+        if labels is not None:
+            assert labels.shape == input_ids.shape
+        if torch.is_tensor(image_features):
+            feature_lens = torch.full((image_features.shape[0],), image_features.shape[1], device=device)
         else:
-            new_input_embeds = torch.stack(new_input_embeds, dim=0)
+            feature_lens = torch.tensor([x.shape[0] for x in image_features], device=device)
+        num_images = feature_lens.shape[0]
+
+        # Output layout for the whole batch: every image token expands to its image's features,
+        # every other token keeps one slot. Images are taken in order, and a row without image
+        # tokens still takes one (text-only samples come with a blank image).
+        is_image = input_ids == IMAGE_TOKEN_INDEX
+        row_images = is_image.sum(dim=1).clamp(min=1)
+        token_image_idx = (torch.cumsum(row_images, dim=0) - row_images)[:, None] + torch.cumsum(is_image, dim=1) - 1
+        token_lens = torch.where(is_image, feature_lens[token_image_idx.clamp(0, num_images - 1)], 1)
+        out_pos = torch.cumsum(token_lens, dim=1) - token_lens
+        new_lens = token_lens.sum(dim=1)
+        max_len = int(new_lens.max())
+        if labels is None:
+            # generation: rows end together in the last column, the padding goes to the left
+            out_pos = out_pos + (max_len - new_lens)[:, None]
+
+        inputs_embeds = self.get_model().embed_tokens(input_ids.masked_fill(is_image, 0))
+        if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
+            # only <im_start>/<im_end> around each image are trained; text-only rows keep their gradients
+            near_image = torch.zeros_like(is_image)
+            near_image[:, 1:] |= is_image[:, :-1]
+            near_image[:, :-1] |= is_image[:, 1:]
+            keep_grad = near_image | ~is_image.any(dim=1, keepdim=True)
+            inputs_embeds = torch.where(keep_grad[..., None], inputs_embeds, inputs_embeds.detach())
             if labels is not None:
-                new_labels  = torch.stack(new_labels, dim=0)
-
-            if attention_mask is not None:
-                new_attn_mask_pad_left = torch.full((attention_mask.shape[0], new_input_embeds.shape[1] - input_ids.shape[1]), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                attention_mask = torch.cat((new_attn_mask_pad_left, attention_mask), dim=1)
-                assert attention_mask.shape == new_input_embeds.shape[:2]
+                # <im_end> takes the label of the image token it follows
+                shifted_labels = labels.clone()
+                shifted_labels[:, 1:] = torch.where(is_image[:, :-1], labels[:, :-1], labels[:, 1:])
+                labels = shifted_labels
+
+        text_rows, text_cols = torch.nonzero(~is_image, as_tuple=True)
+        text_out_cols = out_pos[text_rows, text_cols]
+        image_rows, image_cols = torch.nonzero(is_image, as_tuple=True)
+        image_idx = token_image_idx[image_rows, image_cols]
+        image_lens = feature_lens[image_idx]
+        feature_rows = image_rows.repeat_interleave(image_lens)
+        feature_cols = (out_pos[image_rows, image_cols] - (torch.cumsum(image_lens, dim=0) - image_lens)).repeat_interleave(image_lens) \
+            + torch.arange(feature_rows.shape[0], device=device)
+
+        used_images = image_idx.tolist()
+        # FIXME: every image feature has to be part of the graph for deepspeed zero3 to work
+        unused_features = [image_features[i][0:0] for i in sorted(set(range(num_images)) - set(used_images))]
+        if torch.is_tensor(image_features):
+            image_values = torch.cat([image_features[image_idx].flatten(0, 1)] + unused_features, dim=0)
+        else:
+            image_values = torch.cat([image_features[i] for i in used_images] + unused_features, dim=0)
+
+        new_input_embeds = inputs_embeds.new_zeros((batch_size, max_len, inputs_embeds.shape[-1])).index_put(
+            (torch.cat([text_rows, feature_rows]), torch.cat([text_out_cols, feature_cols])),
+            torch.cat([inputs_embeds[text_rows, text_cols], image_values.to(device=inputs_embeds.device, dtype=inputs_embeds.dtype)], dim=0))
+
+        new_labels = None
+        if labels is not None:
+            new_labels = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=labels.dtype, device=labels.device)
+            new_labels[text_rows, text_out_cols] = labels[text_rows, text_cols]
+
+        if attention_mask is not None:
+            # every slot inherits the mask of the token it came from; the added padding is masked
+            new_attention_mask = torch.zeros((batch_size, max_len), dtype=attention_mask.dtype, device=attention_mask.device)
+            new_attention_mask[text_rows, text_out_cols] = attention_mask[text_rows, text_cols]
+            new_attention_mask[feature_rows, feature_cols] = attention_mask[image_rows, image_cols].repeat_interleave(image_lens)
+            attention_mask = new_attention_mask
 
         return None, attention_mask, past_key_values, new_input_embeds, new_labels
 
@@ -0,0 +1,86 @@
+"""
+Parity checks of the fast paths against the reference paths they replace.
+
+Every check returns `(passed, stats)`. `report` prints any of them in the same format,
+and scripts/check_parity.py runs each one from the command line, exiting non-zero on
+a failure.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def tensor_parity(reference, candidate, max_abs_tol=None, mean_abs_tol=None, min_cosine=None):
+    """Compare two tensors of the same shape, e.g. preprocessed pixels or image features.
+
+    Returns:
+        Tuple[bool, dict]: Whether every given tolerance holds (the cosine similarity is taken
+        along the last dimension and averaged), and the measured statistics.
+    """
+    reference, candidate = reference.float(), candidate.float()
+    diff = (reference - candidate).abs()
+    stats = {
+        "max_abs_diff": diff.max().item(),
+        "mean_abs_diff": diff.mean().item(),
+    }
+    passed = (max_abs_tol is None or stats["max_abs_diff"] <= max_abs_tol) and \
+        (mean_abs_tol is None or stats["mean_abs_diff"] <= mean_abs_tol)
+    if min_cosine is not None:
+        cosine = F.cosine_similarity(reference, candidate, dim=-1)
+        stats["mean_cosine"] = cosine.mean().item()
+        stats["min_cosine"] = cosine.min().item()
+        passed = passed and stats["mean_cosine"] >= min_cosine
+    return passed, stats
+
+
+def report(name, passed, stats):
+    print(f"{name}: {stats} ({'passed' if passed else 'FAILED'})")
+    return passed
+
+
+def _answer_tokens(output_ids, eos_token_id):
+    # generated ids up to the first EOS; what follows is padding
+    output_ids = output_ids.tolist()
+    return output_ids[:output_ids.index(eos_token_id)] if eos_token_id in output_ids else output_ids
+
+
+@torch.inference_mode()
+def check_batched_generation(model, tokenizer, prompts, images, batch_size=8, max_new_tokens=64, speculative=False,
+                             max_examples=5):
+    """Compare batched greedy answers with the answers of the same prompts at batch size 1.
+
+    Args:
+        prompts (List[torch.LongTensor]): 1-D prompt ids on the model's device.
+        images (List[torch.Tensor]): (1, 3, H, W) pixels of each prompt.
+        speculative (bool): Decode the batched side with `generate_speculative`.
+
+    Returns:
+        Tuple[bool, dict]: Whether every answer matched, and the counts plus the first
+        `max_examples` mismatches.
+    """
+    from stingbee.mm_utils import left_pad_input_ids
+    from stingbee.model.speculative import generate_speculative
+
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.unk_token_id
+
+    def generate(rows, speculative=False):
+        input_ids, attention_mask = left_pad_input_ids([prompts[r] for r in rows], pad_token_id)
+        batch_images = torch.cat([images[r] for r in rows], dim=0)
+        if speculative:
+            output_ids = generate_speculative(model, input_ids, attention_mask, images=batch_images, max_new_tokens=max_new_tokens,
+                                              pad_token_id=pad_token_id, eos_token_id=tokenizer.eos_token_id)
+        else:
+            output_ids = model.generate(input_ids, images=batch_images, attention_mask=attention_mask, pad_token_id=pad_token_id,
+                                        do_sample=False, num_beams=1, max_new_tokens=max_new_tokens, use_cache=True)
+        return [_answer_tokens(ids, tokenizer.eos_token_id) for ids in output_ids[:, input_ids.shape[1]:]]
+
+    stats = {"compared": 0, "mismatches": 0, "examples": []}
+    for start in range(0, len(prompts), batch_size):
+        rows = list(range(start, min(start + batch_size, len(prompts))))
+        for row, batched in zip(rows, generate(rows, speculative=speculative)):
+            single = generate([row])[0]
+            stats["compared"] += 1
+            if batched != single:
+                stats["mismatches"] += 1
+                if len(stats["examples"]) < max_examples:
+                    stats["examples"].append({"row": row, "batched": tokenizer.decode(batched), "single": tokenizer.decode(single)})
+    return stats["mismatches"] == 0, stats
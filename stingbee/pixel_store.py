@@ -0,0 +1,87 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from stingbee.image_loader import ImageLoader
+from stingbee.mm_utils import BatchImageProcessor
+
+
+INDEX_FILE = 'index.json'
+
+
+def compile_pixel_store(image_processor, image_folder, image_files, output_dir, size=504, pad_to_square=True,
+                        shard_size=1024, num_workers=0, min_size=None):
+    """Decode, pad and resize `image_files` once into memory-mapped uint8 shards.
+
+    Each shard is a `.npy` array of shape (N, 3, size, size). `index.json` maps every
+    image path (relative to `image_folder`, as written in the data and question files)
+    to its shard and offset.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    processor = BatchImageProcessor.from_image_processor(image_processor, size=size, pad_to_square=pad_to_square)
+    index = {"size": size, "pad_to_square": pad_to_square, "shards": [], "images": {}}
+    with ImageLoader(num_workers, min_size=min_size) as loader:
+        for shard_idx, start in enumerate(range(0, len(image_files), shard_size)):
+            files = image_files[start:start + shard_size]
+            shard_name = f'shard_{shard_idx:05d}.npy'
+            shard = np.lib.format.open_memmap(os.path.join(output_dir, shard_name), mode='w+', dtype=np.uint8,
+                                              shape=(len(files), 3, size, size))
+            images = loader.imap([os.path.join(image_folder, image_file) for image_file in files])
+            for offset, (image_file, image) in enumerate(zip(files, images)):
+                shard[offset] = processor.pixels([image])[0].numpy()
+                index["images"][image_file] = [shard_idx, offset]
+            shard.flush()
+            del shard
+            index["shards"].append(shard_name)
+            print(f"Wrote {shard_name} ({start + len(files)}/{len(image_files)} images)")
+
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+class PixelStore:
+    """Read-only view of a compiled pixel store.
+
+    Shards are memory-mapped lazily in each process, so a store can be shared by
+    DataLoader workers. `get` returns a (3, size, size) uint8 tensor backed by the
+    mapping without copying; only normalization is left to do.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.size = index["size"]
+        self.pad_to_square = index["pad_to_square"]
+        self.shard_names = index["shards"]
+        self.images = index["images"]
+        self.shards = {}
+
+    def check_mode(self, size, pad_to_square):
+        if size != self.size or pad_to_square != self.pad_to_square:
+            raise ValueError(f"Pixel store {self.store_dir} holds size={self.size}, pad_to_square={self.pad_to_square}; "
+                             f"expected size={size}, pad_to_square={pad_to_square}.")
+
+    def __contains__(self, image_file):
+        return image_file in self.images
+
+    def __len__(self):
+        return len(self.images)
+
+    def _shard(self, shard_idx):
+        if shard_idx not in self.shards:
+            # copy-on-write keeps the tensors writable without copying the pages
+            self.shards[shard_idx] = np.load(os.path.join(self.store_dir, self.shard_names[shard_idx]), mmap_mode='c')
+        return self.shards[shard_idx]
+
+    def get(self, image_file):
+        shard_idx, offset = self.images[image_file]
+        return torch.from_numpy(self._shard(shard_idx)[offset])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
@@ -0,0 +1,277 @@
+"""
+Continuous batching for the model worker.
+
+One scheduler thread owns the model and keeps a single running batch. Between two
+decoding steps it admits waiting requests (after prefilling each one with its images)
+and evicts the finished ones, so concurrent requests share every forward pass instead
+of running as separate batch-1 `generate` calls.
+
+Without a `PagedKVCache` the batch carries one left-padded `past_key_values`. With one,
+each sequence keeps its keys and values in blocks of the pool and requests are admitted
+as long as the free blocks cover them.
+"""
+import queue
+import threading
+
+import torch
+import torch.nn.functional as F
+
+from stingbee.model.paged_kv import paged_forward, paged_prefill, splice_prompt
+
+
+def sample_next_tokens(logits, temperatures, top_ps):
+    """Per-row temperature and nucleus sampling; rows with temperature ~0 are greedy."""
+    greedy = temperatures <= 1e-3
+    probs = torch.softmax(logits.float() / temperatures.clamp(min=1e-3)[:, None], dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    # drop tokens once the mass before them already reaches top_p
+    sorted_probs = sorted_probs.masked_fill(sorted_probs.cumsum(dim=-1) - sorted_probs > top_ps[:, None], 0.0)
+    sampled = sorted_idx.gather(-1, torch.multinomial(sorted_probs, 1))[:, 0]
+    return torch.where(greedy, logits.argmax(dim=-1), sampled)
+
+
+def left_pad_past(past_key_values, attention_mask, length):
+    """Left-pad a cache and its mask to `length` positions; the padding is masked."""
+    pad = length - attention_mask.shape[1]
+    if pad == 0:
+        return past_key_values, attention_mask
+    return (tuple(tuple(F.pad(t, (0, 0, pad, 0)) for t in layer) for layer in past_key_values),
+            F.pad(attention_mask, (pad, 0)))
+
+
+class GenerationRequest:
+    """A sequence in the engine; iterate over it for the text generated so far."""
+
+    def __init__(self, input_ids, images=None, temperature=1.0, top_p=1.0, max_new_tokens=256, stop_str=None):
+        self.input_ids = input_ids
+        self.images = images
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_new_tokens = max_new_tokens
+        self.stop_str = stop_str
+        self.output_ids = []
+        self.prompt = None
+        self.num_blocks = 0
+        self.cancelled = False
+        self.outputs = queue.Queue()
+
+    def cancel(self):
+        """Stop generating, e.g. when the client went away."""
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            item = self.outputs.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class BatchEngine:
+    """Iteration-level scheduler over one running batch.
+
+    Args:
+        model: A StingBee causal LM.
+        tokenizer: Its tokenizer, used to stream text and find stop strings.
+        max_batch_size (int): Most sequences decoded together; the rest wait.
+        kv_cache (PagedKVCache): Optional block pool to keep the sequences' keys and values in.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, kv_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.kv_cache = kv_cache
+        self.waiting = queue.Queue()
+        self.head = None
+        self.running = []
+        self.past_key_values = None
+        self.attention_mask = None
+        # written by the scheduler only, read by the heartbeat and status handlers
+        self.free_blocks = kv_cache.num_blocks if kv_cache is not None else None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, input_ids, images=None, temperature=1.0, top_p=1.0, max_new_tokens=256, stop_str=None):
+        request = GenerationRequest(input_ids, images, temperature, top_p, max_new_tokens, stop_str)
+        self.waiting.put(request)
+        return request
+
+    @property
+    def num_requests(self):
+        return len(self.running) + self.waiting.qsize() + (self.head is not None)
+
+    @property
+    def num_free_blocks(self):
+        """Blocks of the pool not yet promised to a running sequence, as of the last step."""
+        return self.free_blocks
+
+    def _unpromised_blocks(self):
+        promised = sum(request.num_blocks - len(self.kv_cache.block_tables[request]) for request in self.running)
+        return self.kv_cache.num_free_blocks - promised
+
+    def _next_waiting(self, block):
+        if self.head is None:
+            try:
+                self.head = self.waiting.get(block=block)
+            except queue.Empty:
+                return None
+        return self.head
+
+    def _blocks_needed(self, request):
+        """Blocks for the whole prompt, as spliced by the vision path, and all new tokens."""
+        if request.prompt is None:
+            request.prompt = splice_prompt(self.model, request.input_ids.to(self.model.device), request.images)
+        prompt_len = next(iter(request.prompt.values())).shape[1]
+        return self.kv_cache.blocks_needed(prompt_len + request.max_new_tokens)
+
+    @torch.inference_mode()
+    def _loop(self):
+        while True:
+            try:
+                self._schedule()
+            except Exception as e:
+                # never let the scheduler thread die: fail what was in flight and carry on
+                self._fail(self.running + ([self.head] if self.head is not None else []), e)
+                self.head = None
+                self._reset()
+            if self.kv_cache is not None:
+                self.free_blocks = self._unpromised_blocks()
+
+    def _schedule(self):
+        """Admit waiting requests up to the batch size, then decode one step."""
+        while len(self.running) < self.max_batch_size:
+            # idle until a request arrives
+            request = self._next_waiting(block=not self.running)
+            if request is None:
+                break
+            if self.kv_cache is not None:
+                try:
+                    request.num_blocks = self._blocks_needed(request)
+                except Exception as e:
+                    self.head = None
+                    self._fail([request], e)
+                    continue
+                if request.num_blocks > self._unpromised_blocks():
+                    if self.running:
+                        # wait for running sequences to hand back their blocks
+                        break
+                    self.head = None
+                    self._fail([request], ValueError("The request does not fit in the paged KV cache."))
+                    continue
+            self.head = None
+            try:
+                self._admit(request)
+            except Exception as e:
+                if self.kv_cache is not None and request in self.kv_cache.block_tables:
+                    self.kv_cache.free_sequence(request)
+                self._fail([request], e)
+        if self.running:
+            try:
+                self._step()
+            except Exception as e:
+                self._fail(self.running, e)
+                self._reset()
+
+    def _reset(self):
+        """Drop the running batch and hand every block back to the pool."""
+        if self.kv_cache is not None:
+            for seq_id in list(self.kv_cache.block_tables):
+                self.kv_cache.free_sequence(seq_id)
+        self.running, self.past_key_values, self.attention_mask = [], None, None
+
+    @staticmethod
+    def _fail(requests, error):
+        for request in requests:
+            request.prompt = None
+            request.outputs.put(error)
+
+    def _admit(self, request):
+        """Prefill `request` and add it to the running batch; the caller handles failures."""
+        if self.kv_cache is not None:
+            logits = paged_prefill(self.model, self.kv_cache, request, request.prompt)
+            # the spliced prompt is in the cache now
+            request.prompt = None
+            if self._emit([request], logits)[0]:
+                self.kv_cache.free_sequence(request)
+            else:
+                self.running.append(request)
+            return
+
+        input_ids = request.input_ids[None].to(self.model.device)
+        outputs = self.model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), images=request.images,
+                             use_cache=True, return_dict=True)
+        # the spliced mask, or the prompt one for text-only requests
+        attention_mask = getattr(outputs, "attention_mask", None)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        past_key_values = outputs.past_key_values
+        if self._emit([request], outputs.logits[:, -1, :])[0]:
+            return
+
+        if not self.running:
+            self.past_key_values, self.attention_mask = past_key_values, attention_mask
+        else:
+            # built aside and swapped in, so a failed merge leaves the running batch intact
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            batch_past, batch_mask = left_pad_past(self.past_key_values, self.attention_mask, length)
+            new_past, new_mask = left_pad_past(past_key_values, attention_mask, length)
+            merged_past = tuple(tuple(torch.cat([a, b], dim=0) for a, b in zip(batch_layer, new_layer))
+                                for batch_layer, new_layer in zip(batch_past, new_past))
+            merged_mask = torch.cat([batch_mask, new_mask.to(batch_mask.dtype)], dim=0)
+            self.past_key_values, self.attention_mask = merged_past, merged_mask
+        self.running.append(request)
+
+    def _step(self):
+        input_ids = torch.tensor([[request.output_ids[-1]] for request in self.running], device=self.model.device)
+        if self.kv_cache is not None:
+            finished = self._emit(self.running, paged_forward(self.model, self.kv_cache, self.running, input_ids=input_ids))
+            if any(finished):
+                self._evict([row for row, done in enumerate(finished) if not done])
+            return
+
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.running), 1))], dim=1)
+        outputs = self.model(input_ids=input_ids, attention_mask=self.attention_mask, past_key_values=self.past_key_values,
+                             use_cache=True, return_dict=True)
+        self.past_key_values = outputs.past_key_values
+        finished = self._emit(self.running, outputs.logits[:, -1, :])
+        if any(finished):
+            self._evict([row for row, done in enumerate(finished) if not done])
+
+    def _emit(self, requests, logits):
+        """Sample one token per request, stream its text and report which requests are done."""
+        temperatures = torch.tensor([request.temperature for request in requests], device=logits.device)
+        top_ps = torch.tensor([request.top_p for request in requests], device=logits.device)
+        next_tokens = sample_next_tokens(logits, temperatures, top_ps).tolist()
+        finished = []
+        for request, token in zip(requests, next_tokens):
+            request.output_ids.append(token)
+            text = self.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+            done = request.cancelled or token == self.tokenizer.eos_token_id or len(request.output_ids) >= request.max_new_tokens
+            if request.stop_str and request.stop_str in text:
+                text, done = text[:text.index(request.stop_str)], True
+            request.outputs.put(text)
+            if done:
+                request.outputs.put(None)
+            finished.append(done)
+        return finished
+
+    def _evict(self, keep):
+        if self.kv_cache is not None:
+            for row, request in enumerate(self.running):
+                if row not in keep:
+                    self.kv_cache.free_sequence(request)
+        self.running = [self.running[row] for row in keep]
+        if self.kv_cache is not None:
+            return
+        if not self.running:
+            self.past_key_values, self.attention_mask = None, None
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop the columns that were only padding for the evicted rows
+        start = int(attention_mask.any(dim=0).nonzero()[0])
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = tuple(tuple(t.index_select(0, index)[:, :, start:] for t in layer) for layer in self.past_key_values)
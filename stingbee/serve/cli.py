@@ -9,12 +9,11 @@ from llava.mm_utils import process_images, tokenizer_image_token, get_model_name
 import matplotlib.pyplot as plt
 from matplotlib.patches import Polygon, Circle, Rectangle
 from matplotlib.collections import PatchCollection
-from PIL import Image
 import numpy as np
 import requests
-from PIL import Image
 from io import BytesIO
 from transformers import TextStreamer
+from stingbee.image_loader import open_image
 import math
 import cv2
 def scale_bounding_box(box, scale_factor=1.2):
@@ -40,12 +39,12 @@ def scale_bounding_box(box, scale_factor=1.2):
 
 
 
-def load_image(image_file):
+def load_image(image_file, min_size=None):
     if image_file.startswith('http://') or image_file.startswith('https://'):
         response = requests.get(image_file)
-        image = Image.open(BytesIO(response.content)).convert('RGB')
+        image = open_image(BytesIO(response.content), min_size=min_size)
     else:
-        image = Image.open(image_file).convert('RGB')
+        image = open_image(image_file, min_size=min_size)
     return image
 def bbox_and_angle_to_polygon(x1, y1, x2, y2, a):
     # Calculate center coordinates
@@ -108,7 +107,7 @@ def main(args):
     else:
         roles = conv.roles
 
-    image = load_image(args.image_file)
+    image = load_image(args.image_file, min_size=504 if args.jpeg_draft else None)
     # Similar operation in model_worker.py
     image_tensor = process_images([image], image_processor, args)
     if type(image_tensor) is list:
@@ -212,5 +211,6 @@ if __name__ == "__main__":
     parser.add_argument("--load-4bit", action="store_true")
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--image-aspect-ratio", type=str, default='pad')
+    parser.add_argument("--jpeg-draft", action="store_true", help="Decode JPEGs at the smallest DCT scale that keeps the short side at least 504px.")
     args = parser.parse_args()
     main(args)
@@ -20,6 +20,7 @@ import uvicorn
 
 from llava.constants import CONTROLLER_HEART_BEAT_EXPIRATION
 from llava.utils import build_logger, server_error_msg
+from stingbee.serve.transport import FRAME_CONTENT_TYPE, read_header
 
 
 logger = build_logger("controller", "controller.log")
@@ -190,7 +191,7 @@ class Controller:
         for worker_name in to_delete:
             self.remove_worker(worker_name)
 
-    def worker_api_generate_stream(self, params):
+    def worker_api_generate_stream(self, params, body=None):
         worker_addr = self.get_worker_address(params["model"])
         if not worker_addr:
             logger.info(f"no worker: {params['model']}")
@@ -201,8 +202,13 @@ class Controller:
             yield json.dumps(ret).encode() + b"\0"
 
         try:
-            response = requests.post(worker_addr + "/worker_generate_stream",
-                json=params, stream=True, timeout=5)
+            if body is not None:
+                # binary frames are forwarded untouched
+                response = requests.post(worker_addr + "/worker_generate_stream",
+                    data=body, headers={"Content-Type": FRAME_CONTENT_TYPE}, stream=True, timeout=5)
+            else:
+                response = requests.post(worker_addr + "/worker_generate_stream",
+                    json=params, stream=True, timeout=5)
             for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
                 if chunk:
                     yield chunk + b"\0"
@@ -275,8 +281,13 @@ async def receive_heart_beat(request: Request):
 
 @app.post("/worker_generate_stream")
 async def worker_api_generate_stream(request: Request):
-    params = await request.json()
-    generator = controller.worker_api_generate_stream(params)
+    body = None
+    if request.headers.get("content-type") == FRAME_CONTENT_TYPE:
+        body = await request.body()
+        params, _ = read_header(body)
+    else:
+        params = await request.json()
+    generator = controller.worker_api_generate_stream(params, body)
     return StreamingResponse(generator)
 
 
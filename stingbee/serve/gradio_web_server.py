@@ -13,12 +13,17 @@ from llava.constants import LOGDIR
 from llava.utils import (build_logger, server_error_msg,
     violates_moderation, moderation_msg)
 import hashlib
+from stingbee.serve.transport import (FRAME_CONTENT_TYPE, IMAGE_TRANSPORTS, OPENAI_CLIP_MEAN, encode_request,
+                                      release_shared_memory, resolve_transport)
 
 
 logger = build_logger("gradio_web_server", "gradio_web_server.log")
 
 headers = {"User-Agent": "LLaVA Client"}
 
+# image preprocessing settings of each worker, for binary image frames
+worker_image_settings = {}
+
 no_change_btn = gr.Button.update()
 enable_btn = gr.Button.update(interactive=True)
 disable_btn = gr.Button.update(interactive=False)
@@ -153,6 +158,20 @@ def add_text(state, text, image, image_process_mode, request: gr.Request):
     return (state, state.to_gradio_chatbot(), "", None) + (disable_btn,) * 5
 
 
+def get_worker_image_settings(worker_addr):
+    """`image_aspect_ratio` and `image_mean` of a worker; unknown settings fall back to JPEG frames."""
+    if worker_addr not in worker_image_settings:
+        try:
+            status = requests.post(worker_addr + "/worker_get_status", headers=headers, timeout=5).json()
+        except requests.exceptions.RequestException:
+            status = {}
+        worker_image_settings[worker_addr] = {
+            "image_aspect_ratio": status.get("image_aspect_ratio"),
+            "image_mean": tuple(status.get("image_mean") or OPENAI_CLIP_MEAN),
+        }
+    return worker_image_settings[worker_addr]
+
+
 def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request: gr.Request):
     logger.info(f"http_bot. ip: {request.client.host}")
     start_tstamp = time.time()
@@ -228,19 +247,28 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         "top_p": float(top_p),
         "max_new_tokens": min(int(max_new_tokens), 1536),
         "stop": state.sep if state.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.MPT] else state.sep2,
-        "images": f'List of {len(state.get_images())} images: {all_image_hash}',
+        "images": f'List of {len(all_images)} images: {all_image_hash}',
     }
     logger.info(f"==== request ====\n{pload}")
 
-    pload['images'] = state.get_images()
-
     state.messages[-1][-1] = "▌"
     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
 
+    shm_blocks = []
     try:
+        if args.image_transport == "json":
+            pload['images'] = state.get_images()
+            post_kwargs = {"headers": headers, "json": pload}
+        else:
+            # binary frames skip the PNG + base64 round trip
+            image_settings = get_worker_image_settings(worker_addr)
+            transport = resolve_transport(args.image_transport, worker_addr, image_settings["image_aspect_ratio"])
+            post_kwargs = {"headers": dict(headers, **{"Content-Type": FRAME_CONTENT_TYPE}),
+                           "data": encode_request(pload, all_images, transport, shm_blocks=shm_blocks, **image_settings)}
+
         # Stream output
         response = requests.post(worker_addr + "/worker_generate_stream",
-            headers=headers, json=pload, stream=True, timeout=10)
+            stream=True, timeout=10, **post_kwargs)
         for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
             if chunk:
                 data = json.loads(chunk.decode())
@@ -258,6 +286,9 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         state.messages[-1][-1] = server_error_msg
         yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
         return
+    finally:
+        # the worker has copied the pixels out once it answers, or never will
+        release_shared_memory(shm_blocks)
 
     state.messages[-1][-1] = state.messages[-1][-1][:-1]
     yield (state, state.to_gradio_chatbot()) + (enable_btn,) * 5
@@ -403,6 +434,8 @@ if __name__ == "__main__":
     parser.add_argument("--share", action="store_true")
     parser.add_argument("--moderate", action="store_true")
     parser.add_argument("--embed", action="store_true")
+    parser.add_argument("--image-transport", type=str, default="json", choices=IMAGE_TRANSPORTS,
+        help="How images reach the worker: base64 PNG in JSON, or binary frames with JPEG bytes, preprocessed pixels or shared memory ('auto' uses shared memory for a local worker).")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -21,6 +21,9 @@ from llava.utils import (build_logger, server_error_msg,
 from llava.model.builder import load_pretrained_model
 from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token, KeywordsStoppingCriteria
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+from stingbee.serve.transport import FRAME_CONTENT_TYPE, decode_request
+from stingbee.serve.batch_engine import BatchEngine
+from stingbee.model.paged_kv import PagedKVCache
 from transformers import TextIteratorStreamer
 from threading import Thread
 
@@ -45,7 +48,7 @@ class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device):
+                 load_8bit, load_4bit, device, max_batch_size=0, kv_cache_gb=0):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -65,6 +68,11 @@ class ModelWorker:
         self.tokenizer, self.model, self.image_processor, self.context_len = load_pretrained_model(
             model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device)
         self.is_multimodal = 'llava' in self.model_name.lower()
+        # one running batch shared by all requests instead of a generate thread per request
+        self.batch_engine = None
+        if max_batch_size > 0:
+            kv_cache = PagedKVCache.for_model(self.model, kv_cache_gb * GB) if kv_cache_gb > 0 else None
+            self.batch_engine = BatchEngine(self.model, self.tokenizer, max_batch_size, kv_cache=kv_cache)
 
         if not no_register:
             self.register_to_controller()
@@ -84,9 +92,17 @@ class ModelWorker:
         r = requests.post(url, json=data)
         assert r.status_code == 200
 
+    @property
+    def is_paged(self):
+        return self.batch_engine is not None and self.batch_engine.kv_cache is not None
+
     def send_heart_beat(self):
+        if self.is_paged:
+            capacity = f"Free KV blocks: {self.batch_engine.num_free_blocks}/{self.batch_engine.kv_cache.num_blocks}"
+        else:
+            capacity = f"Semaphore: {pretty_print_semaphore(model_semaphore)}"
         logger.info(f"Send heart beat. Models: {[self.model_name]}. "
-                    f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
+                    f"{capacity}. "
                     f"global_counter: {global_counter}")
 
         url = self.controller_addr + "/receive_heart_beat"
@@ -106,6 +122,9 @@ class ModelWorker:
             self.register_to_controller()
 
     def get_queue_length(self):
+        if self.is_paged:
+            # requests are admitted by free blocks, not by the semaphore
+            return self.batch_engine.num_requests
         if model_semaphore is None:
             return 0
         else:
@@ -113,11 +132,19 @@ class ModelWorker:
                 model_semaphore._waiters) if model_semaphore._waiters is not None else 0)
 
     def get_status(self):
-        return {
+        status = {
             "model_names": [self.model_name],
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            # what a sender needs to preprocess pixels for this worker
+            "image_aspect_ratio": getattr(self.model.config, "image_aspect_ratio", None),
+            "image_mean": list(self.image_processor.image_mean) if self.image_processor is not None else None,
         }
+        if self.is_paged:
+            status["free_blocks"] = self.batch_engine.num_free_blocks
+            status["num_blocks"] = self.batch_engine.kv_cache.num_blocks
+            status["block_size"] = self.batch_engine.kv_cache.block_size
+        return status
 
     @torch.inference_mode()
     def generate_stream(self, params):
@@ -132,7 +159,8 @@ class ModelWorker:
                 if len(images) != prompt.count(DEFAULT_IMAGE_TOKEN):
                     raise ValueError("Number of images does not match number of <image> tokens in prompt")
 
-                images = [load_image_from_base64(image) for image in images]
+                # binary frames arrive already decoded (PIL images or uint8 pixels)
+                images = [load_image_from_base64(image) if isinstance(image, str) else image for image in images]
                 images = process_images(images, image_processor, model.config)
 
                 if type(images) is list:
@@ -171,6 +199,17 @@ class ModelWorker:
             yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
             return
 
+        if self.batch_engine is not None:
+            request = self.batch_engine.submit(input_ids[0], images=images, temperature=temperature, top_p=top_p,
+                                               max_new_tokens=max_new_tokens, stop_str=stop_str)
+            try:
+                for text in request:
+                    yield json.dumps({"text": ori_prompt + text, "error_code": 0}).encode() + b"\0"
+            finally:
+                # the client may have disconnected before the end
+                request.cancel()
+            return
+
         thread = Thread(target=model.generate, kwargs=dict(
             inputs=input_ids,
             do_sample=do_sample,
@@ -231,7 +270,17 @@ def release_model_semaphore(fn=None):
 async def generate_stream(request: Request):
     global model_semaphore, global_counter
     global_counter += 1
-    params = await request.json()
+    if request.headers.get("content-type") == FRAME_CONTENT_TYPE:
+        params = decode_request(await request.body())
+    else:
+        params = await request.json()
+
+    if worker.is_paged:
+        # the batch engine admits requests as KV blocks free up
+        worker.send_heart_beat()
+        background_tasks = BackgroundTasks()
+        background_tasks.add_task(worker.send_heart_beat)
+        return StreamingResponse(worker.generate_stream_gate(params), background=background_tasks)
 
     if model_semaphore is None:
         model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
@@ -263,6 +312,12 @@ if __name__ == "__main__":
     parser.add_argument("--multi-modal", action="store_true", help="Multimodal mode is automatically detected with model name, please make sure `llava` is included in the model path.")
     parser.add_argument("--limit-model-concurrency", type=int, default=5)
     parser.add_argument("--stream-interval", type=int, default=1)
+    parser.add_argument("--max-batch-size", type=int, default=0,
+        help="Decode up to this many requests together in one continuously refilled batch; 0 runs a generate thread per request. "
+             "Keep --limit-model-concurrency at least this large.")
+    parser.add_argument("--kv-cache-gb", type=float, default=0,
+        help="With --max-batch-size, keep the KV cache in a paged pool of this size and admit requests by free blocks "
+             "instead of --limit-model-concurrency.")
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
@@ -281,5 +336,7 @@ if __name__ == "__main__":
                          args.model_name,
                          args.load_8bit,
                          args.load_4bit,
-                         args.device)
+                         args.device,
+                         args.max_batch_size,
+                         args.kv_cache_gb)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -0,0 +1,138 @@
+"""
+Binary framing of /worker_generate_stream requests.
+
+A frame is MAGIC, a little-endian uint32 header length, a JSON header holding the
+request params (with `images` replaced by payload descriptors), and then the image
+payloads back to back. Payloads are either JPEG bytes or preprocessed uint8 pixels
+(3, 504, 504). When the worker runs on the same host, the pixels can be handed over
+in shared memory instead, and then only the block name travels in the frame. The
+sender owns those blocks and unlinks them once the request is done.
+
+Pixels are only sent to workers that pad images to a square (`image_aspect_ratio`
+"pad"); other workers get JPEG, as the sender cannot reproduce their preprocessing.
+"""
+import json
+import socket
+import struct
+from io import BytesIO
+from multiprocessing import resource_tracker, shared_memory
+from urllib.parse import urlparse
+
+import numpy as np
+from PIL import Image
+
+
+FRAME_CONTENT_TYPE = "application/x-stingbee-frames"
+MAGIC = b"SBF1"
+IMAGE_TRANSPORTS = ["json", "jpeg", "pixels", "shm", "auto"]
+
+OPENAI_CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+OPENAI_CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def is_local_address(url):
+    host = urlparse(url).hostname
+    return host in ("localhost", "127.0.0.1", "::1", socket.gethostname(), socket.getfqdn())
+
+
+def resolve_transport(transport, worker_addr, image_aspect_ratio="pad"):
+    """'auto' hands images over in shared memory to a local padding worker and as JPEG otherwise."""
+    if transport == "auto":
+        return "shm" if is_local_address(worker_addr) and image_aspect_ratio == "pad" else "jpeg"
+    if transport in ("pixels", "shm") and image_aspect_ratio != "pad":
+        return "jpeg"
+    return transport
+
+
+def preprocess_pixels(images, image_mean=OPENAI_CLIP_MEAN, image_aspect_ratio="pad", size=504):
+    """Pad and resize on the sender so the worker only normalizes: (N, 3, size, size) uint8.
+
+    `image_mean` and `image_aspect_ratio` are the worker's, as reported by /worker_get_status.
+    """
+    from stingbee.mm_utils import BatchImageProcessor
+    if image_aspect_ratio != "pad":
+        raise ValueError(f"Pixels can only be sent to a worker padding images to a square, not '{image_aspect_ratio}'.")
+    processor = BatchImageProcessor(image_mean, OPENAI_CLIP_STD, size=size)
+    return processor.pixels(images).numpy()
+
+
+def release_shared_memory(blocks):
+    """Unlink the blocks `encode_request` created, once the worker is done with the request."""
+    for shm in blocks:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    blocks.clear()
+
+
+def encode_request(params, images, transport="jpeg", jpeg_quality=95, image_mean=OPENAI_CLIP_MEAN,
+                   image_aspect_ratio="pad", shm_blocks=None):
+    """Frame of `params` and `images`.
+
+    With the "shm" transport the created blocks are appended to `shm_blocks`; the caller
+    passes them to `release_shared_memory` after the request, whether it succeeded or not.
+    """
+    descriptors, payloads = [], []
+    if transport == "jpeg":
+        for image in images:
+            buffered = BytesIO()
+            image.convert("RGB").save(buffered, format="JPEG", quality=jpeg_quality)
+            payloads.append(buffered.getvalue())
+            descriptors.append({"kind": "jpeg", "nbytes": len(payloads[-1])})
+    elif transport == "pixels":
+        for pixels in preprocess_pixels(images, image_mean, image_aspect_ratio):
+            payloads.append(pixels.tobytes())
+            descriptors.append({"kind": "pixels", "shape": list(pixels.shape), "nbytes": pixels.nbytes})
+    elif transport == "shm":
+        if shm_blocks is None:
+            raise ValueError("The shm transport needs a `shm_blocks` list to release the blocks after the request.")
+        for pixels in preprocess_pixels(images, image_mean, image_aspect_ratio):
+            shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+            shm_blocks.append(shm)
+            np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)[:] = pixels
+            shm.close()
+            descriptors.append({"kind": "shm", "name": shm.name, "shape": list(pixels.shape), "nbytes": 0})
+    else:
+        raise ValueError(f"Unsupported image transport: {transport}")
+
+    header = json.dumps(dict(params, images=descriptors)).encode()
+    return b"".join([MAGIC, struct.pack("<I", len(header)), header] + payloads)
+
+
+def read_header(body):
+    """Request params of a frame, and the offset of its first payload."""
+    if body[:len(MAGIC)] != MAGIC:
+        raise ValueError("Request body is not an image frame")
+    (header_len,) = struct.unpack_from("<I", body, len(MAGIC))
+    start = len(MAGIC) + 4
+    return json.loads(body[start:start + header_len]), start + header_len
+
+
+def decode_request(body):
+    """Request params with `images` decoded to PIL images (JPEG) or uint8 tensors (pixels)."""
+    import torch
+
+    params, offset = read_header(body)
+    images = []
+    for descriptor in params.get("images", []):
+        kind = descriptor["kind"]
+        if kind == "jpeg":
+            images.append(Image.open(BytesIO(body[offset:offset + descriptor["nbytes"]])))
+        elif kind == "pixels":
+            pixels = np.frombuffer(body, dtype=np.uint8, count=descriptor["nbytes"], offset=offset)
+            images.append(torch.from_numpy(pixels.reshape(descriptor["shape"]).copy()))
+        elif kind == "shm":
+            shm = shared_memory.SharedMemory(name=descriptor["name"])
+            # the sender owns and unlinks the block; keep this process's tracker off it
+            resource_tracker.unregister(shm._name, "shared_memory")
+            try:
+                pixels = np.ndarray(descriptor["shape"], dtype=np.uint8, buffer=shm.buf).copy()
+            finally:
+                shm.close()
+            images.append(torch.from_numpy(pixels))
+        else:
+            raise ValueError(f"Unknown image payload: {kind}")
+        offset += descriptor["nbytes"]
+    params["images"] = images
+    return params
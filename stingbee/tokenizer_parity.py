@@ -0,0 +1,111 @@
+import copy
+from types import SimpleNamespace
+
+from stingbee import conversation as conversation_lib
+from stingbee.constants import DEFAULT_IMAGE_TOKEN
+from stingbee.mm_utils import tokenizer_image_token
+
+
+# prompts every StingBee checkpoint sees; checked before the fast tokenizer is used at all
+PROBE_QUESTIONS = [
+    "Identify the object in the X-ray scan. Select from the following options:\nA. Gun\nB. Knife\nC. Wrench\nD. Battery\nOnly provide the option letter as the answer.",
+    "Describe the prohibited items in this baggage scan.",
+    "[grounding] Locate the gun in the image.",
+    "[refer] Where is the knife?",
+    "Is there a threat in this bag?  Answer yes or no.",
+]
+PROBE_ANSWERS = [
+    "B",
+    "The scan shows a folded knife next to a laptop.",
+    "<p>Gun</p> {<12><40><37><68>}",
+    "{<51><8><73><30>}",
+    "Yes, there is a pair of scissors.</s>",
+]
+
+
+def question_prompt(question, conv_mode="llava_v1"):
+    """Prompt of a single-image question, laid out as the eval scripts send it."""
+    conv = conversation_lib.conv_templates[conv_mode].copy()
+    conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + '\n' + question)
+    conv.append_message(conv.roles[1], None)
+    return conv.get_prompt()
+
+
+def probe_sources():
+    """A few multi-turn training samples in the instruct JSON format."""
+    sources = []
+    for question, answer in zip(PROBE_QUESTIONS, PROBE_ANSWERS):
+        sources.append([{"from": "human", "value": DEFAULT_IMAGE_TOKEN + '\n' + question}, {"from": "gpt", "value": answer}])
+    sources.append([turn for source in sources[:3] for turn in source])
+    return sources
+
+
+def probe_prompts(conv_mode="llava_v1"):
+    """Full prompts of the probe samples, with the history a multi-turn chat sends."""
+    prompts = []
+    for source in probe_sources():
+        conv = conversation_lib.conv_templates[conv_mode].copy()
+        for j, sentence in enumerate(source):
+            conv.append_message(conv.roles[j % 2], sentence["value"])
+        conv.append_message(conv.roles[0], PROBE_QUESTIONS[1])
+        conv.append_message(conv.roles[1], None)
+        prompts.append(conv.get_prompt())
+    return prompts
+
+
+def check_tokenizer_parity(slow_tokenizer, fast_tokenizer, questions=(), prompts=(), sources=(), conv_mode="llava_v1",
+                           data_args=None, max_examples=5):
+    """Compare the ids produced by a slow and a fast tokenizer of the same checkpoint.
+
+    Every question is compared as plain text, as a `conv_mode` prompt split on `<image>`
+    by `tokenizer_image_token`, and by decoding the slow ids with both tokenizers (the
+    stopping criteria and streamers decode). Every prompt is compared as it is, through
+    `tokenizer_image_token`. Every source is a conversation in the
+    instruct JSON format; it goes through `preprocess_multimodal` and `preprocess` of the
+    training code with both tokenizers and `conv_mode` as the default conversation, so the
+    round-boundary masking of `preprocess_v1` is compared too; both tokenizers need their
+    training `pad_token` set for that.
+
+    Returns:
+        Tuple[bool, dict]: Whether every comparison matched exactly, and the counts plus
+        the first `max_examples` mismatches.
+    """
+    stats = {"compared": 0, "mismatches": 0, "examples": []}
+
+    def compare(kind, text, slow, fast):
+        stats["compared"] += 1
+        if slow != fast:
+            stats["mismatches"] += 1
+            if len(stats["examples"]) < max_examples:
+                stats["examples"].append({"kind": kind, "text": text, "slow": slow, "fast": fast})
+
+    for question in questions:
+        slow_ids = slow_tokenizer(question).input_ids
+        compare("text", question, slow_ids, fast_tokenizer(question).input_ids)
+        compare("decode", question, slow_tokenizer.decode(slow_ids, skip_special_tokens=True),
+                fast_tokenizer.decode(slow_ids, skip_special_tokens=True))
+        prompt = question_prompt(question, conv_mode)
+        compare("prompt", prompt, tokenizer_image_token(prompt, slow_tokenizer), tokenizer_image_token(prompt, fast_tokenizer))
+
+    for prompt in prompts:
+        compare("prompt", prompt, tokenizer_image_token(prompt, slow_tokenizer), tokenizer_image_token(prompt, fast_tokenizer))
+
+    if len(sources) > 0:
+        from stingbee.train.train import preprocess, preprocess_multimodal
+        if data_args is None:
+            data_args = SimpleNamespace(is_multimodal=True, mm_use_im_start_end=False)
+        default_conversation = conversation_lib.default_conversation
+        conversation_lib.default_conversation = conversation_lib.conv_templates[conv_mode]
+        try:
+            for source in sources:
+                has_image = any(DEFAULT_IMAGE_TOKEN in sentence["value"] for sentence in source)
+                source = preprocess_multimodal([copy.deepcopy(source)], data_args)
+                slow = preprocess(source, slow_tokenizer, has_image=has_image)
+                fast = preprocess(source, fast_tokenizer, has_image=has_image)
+                text = source[0][0]["value"]
+                compare("input_ids", text, slow["input_ids"][0].tolist(), fast["input_ids"][0].tolist())
+                compare("labels", text, slow["labels"][0].tolist(), fast["labels"][0].tolist())
+        finally:
+            conversation_lib.default_conversation = default_conversation
+
+    return stats["mismatches"] == 0, stats
@@ -17,6 +17,7 @@
 import os
 import copy
 from dataclasses import dataclass, field
+from types import SimpleNamespace
 import json
 import logging
 import pathlib
@@ -32,7 +33,10 @@ from stingbee.train.stingbee_trainer import StingBeeTrainer
 
 from stingbee import conversation as conversation_lib
 from stingbee.model import *
-from stingbee.mm_utils import tokenizer_image_token
+from stingbee.mm_utils import tokenizer_image_token, resize_to_token_budget, BatchImageProcessor
+from stingbee.image_loader import open_image
+from stingbee.pixel_store import PixelStore
+from stingbee.tokenizer_parity import check_tokenizer_parity
 
 from PIL import Image
 
@@ -58,6 +62,8 @@ class ModelArguments:
     mm_use_im_start_end: bool = field(default=False)
     mm_use_im_patch_token: bool = field(default=True)
     mm_vision_select_feature: Optional[str] = field(default="patch")
+    use_fast_tokenizer: bool = field(default=False,
+                                     metadata={"help": "Use the fast tokenizer if it matches the slow one on the whole training data."})
 
 
 @dataclass
@@ -69,6 +75,11 @@ class DataArguments:
     image_folder: Optional[str] = field(default=None)
     image_aspect_ratio: str = 'square'
     image_grid_pinpoints: Optional[str] = field(default=None)
+    image_grid_token_budget: int = 1296
+    fast_image_preprocess: bool = False
+    jpeg_draft: bool = False
+    pixel_store: Optional[str] = field(default=None,
+                                       metadata={"help": "Directory written by scripts/compile_pixel_store.py."})
 
 
 @dataclass
@@ -641,6 +652,20 @@ class LazySupervisedDataset(Dataset):
         self.tokenizer = tokenizer
         self.list_data_dict = list_data_dict
         self.data_args = data_args
+        self.pixel_store = None
+        if data_args.pixel_store is not None:
+            if data_args.image_aspect_ratio == 'grid':
+                raise ValueError("The pixel store holds fixed-size images and cannot serve image_aspect_ratio='grid'.")
+            self.pixel_store = PixelStore(data_args.pixel_store)
+            self.pixel_store.check_mode(504, data_args.image_aspect_ratio == 'pad')
+        # torch preprocessing engines, built once and shared by every item
+        processor = getattr(data_args, 'image_processor', None)
+        self.store_processor = self.fast_processor = None
+        if processor is not None and self.pixel_store is not None:
+            self.store_processor = BatchImageProcessor.from_image_processor(processor, size=504, dtype=torch.float32)
+        if processor is not None and data_args.fast_image_preprocess and data_args.image_aspect_ratio != 'grid':
+            self.fast_processor = BatchImageProcessor.from_image_processor(processor, size=504, pad_to_square=data_args.image_aspect_ratio == 'pad',
+                                                                           dtype=torch.float32)
 
     def __len__(self):
         return len(self.list_data_dict)
@@ -671,9 +696,16 @@ class LazySupervisedDataset(Dataset):
             image_file = self.list_data_dict[i]['image']
             image_folder = self.data_args.image_folder
             processor = self.data_args.image_processor
-            image = Image.open((os.path.join(image_folder, image_file)).strip()).convert('RGB')
-
-            if self.data_args.image_aspect_ratio == 'pad':
+            in_store = self.pixel_store is not None and image_file in self.pixel_store
+            if not in_store:
+                image = open_image((os.path.join(image_folder, image_file)).strip(), min_size=504 if self.data_args.jpeg_draft else None)
+
+            if in_store:
+                # decoded, padded and resized offline; only normalization is left
+                image = self.store_processor([self.pixel_store.get(image_file)])[0]
+            elif self.fast_processor is not None:
+                image = self.fast_processor([image])[0]
+            elif self.data_args.image_aspect_ratio == 'pad':
                 def expand2square(pil_img, background_color):
                     width, height = pil_img.size
                     if width == height:
@@ -689,6 +721,9 @@ class LazySupervisedDataset(Dataset):
                 image = expand2square(image, tuple(int(x*255) for x in processor.image_mean))
                 # image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
                 image = processor.preprocess(image,do_resize=True,crop_size ={'height': 504, 'width': 504},size = {'shortest_edge': 504}, return_tensors='pt')['pixel_values'][0]
+            elif self.data_args.image_aspect_ratio == 'grid':
+                image = resize_to_token_budget(image, self.data_args.image_grid_token_budget)
+                image = processor.preprocess(image, do_resize=False, do_center_crop=False, return_tensors='pt')['pixel_values'][0]
             else:
                 # image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
                 image = processor.preprocess(image,do_resize=True,crop_size ={'height': 504, 'width': 504},size = {'shortest_edge': 504}, return_tensors='pt')['pixel_values'][0]
@@ -762,6 +797,30 @@ def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
                 data_collator=data_collator)
 
 
+def select_fast_tokenizer(tokenizer, model_args, data_args, training_args):
+    """Swap in the fast tokenizer only if it gives the same input ids and labels on every training sample."""
+    fast_tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_args.model_name_or_path,
+        cache_dir=training_args.cache_dir,
+        model_max_length=training_args.model_max_length,
+        padding_side="right",
+        use_fast=True,
+    )
+    # same pad token as the slow tokenizer, added at the same id if it is new ('[PAD]' for v0)
+    fast_tokenizer.add_special_tokens(dict(pad_token=tokenizer.pad_token))
+    conv_mode = model_args.version if model_args.version in conversation_lib.conv_templates else "vicuna_v1"
+    sources = [sample["conversations"] for sample in json.load(open(data_args.data_path, "r"))]
+    passed, stats = check_tokenizer_parity(
+        tokenizer, fast_tokenizer, sources=sources, conv_mode=conv_mode,
+        data_args=SimpleNamespace(is_multimodal=model_args.vision_tower is not None, mm_use_im_start_end=model_args.mm_use_im_start_end))
+    if not passed:
+        rank0_print(f"Fast tokenizer differs on {stats['mismatches']}/{stats['compared']} checks "
+                    f"(first: {stats['examples'][0]}); keeping the slow tokenizer.")
+        return tokenizer
+    rank0_print(f"Fast tokenizer matches the slow one on {len(sources)} samples.")
+    return fast_tokenizer
+
+
 def train():
     global local_rank
     
@@ -884,6 +943,9 @@ def train():
         else:
             conversation_lib.default_conversation = conversation_lib.conv_templates["vicuna_v1"]
 
+    if model_args.use_fast_tokenizer and 'mpt' not in model_args.model_name_or_path:
+        tokenizer = select_fast_tokenizer(tokenizer, model_args, data_args, training_args)
+
     if model_args.vision_tower is not None:
         model.get_model().initialize_vision_modules(
             model_args=model_args,
@@ -899,6 +961,7 @@ def train():
 
         model.config.image_aspect_ratio = data_args.image_aspect_ratio
         model.config.image_grid_pinpoints = data_args.image_grid_pinpoints
+        model.config.image_grid_token_budget = data_args.image_grid_token_budget
 
         model.config.tune_mm_mlp_adapter = training_args.tune_mm_mlp_adapter = model_args.tune_mm_mlp_adapter
         if model_args.tune_mm_mlp_adapter:
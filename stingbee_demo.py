@@ -33,6 +33,11 @@ def parse_args():
     parser.add_argument("--load-4bit", action="store_true")
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--image-aspect-ratio", type=str, default='pad')
+    parser.add_argument("--embedding-cache-gb", type=float, default=1.0, help="Cache image embeddings across chat turns (0 disables it).")
+    parser.add_argument("--fast-preprocess", action="store_true", help="Preprocess images with the batched torch engine instead of PIL + CLIPImageProcessor.")
+    parser.add_argument("--session-cache-gb", type=float, default=2.0, help="Keep the KV cache of chat sessions between turns (0 disables it).")
+    parser.add_argument("--image-grid-token-budget", type=int, default=None, help="Keep the aspect ratio of scans with at most this many visual tokens (grid mode).")
+    parser.add_argument("--fast-tokenizer", action="store_true", help="Use the fast tokenizer if it matches the slow one on the probe prompts.")
     # args = parser.parse_args()
     args = parser.parse_args()
     return args
@@ -50,7 +55,9 @@ args = parse_args()
 # cfg = Config(args)
 
 model_name = get_model_name_from_path(args.model_path)
-tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, args.load_8bit, args.load_4bit, device=args.device)
+tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, args.load_8bit, args.load_4bit, device=args.device,
+                                                                       embedding_cache_bytes=int(args.embedding_cache_gb * (1 << 30)), use_fast_tokenizer=args.fast_tokenizer,
+                                                                       image_grid_token_budget=args.image_grid_token_budget)
 
 device = 'cuda:{}'.format(args.gpu_id)
 
@@ -380,6 +387,7 @@ def visualize_all_bbox_together(image, generation):
 
 
 def gradio_reset(chat_state, img_list):
+    chat.reset_session(chat_state)
     if chat_state is not None:
         chat_state.messages = []
     if img_list is not None:
@@ -430,6 +438,7 @@ def gradio_ask(user_message, chatbot, chat_state, gr_img, img_list, upload_flag,
 
     if upload_flag:
         if replace_flag:
+            chat.reset_session(chat_state)
             chat_state = CONV_VISION.copy()  # new image, reset everything
             replace_flag = 0
             chatbot = []
@@ -519,7 +528,8 @@ def gradio_taskselect(idx):
 
 
 
-chat = Chat(model, image_processor,tokenizer, device=device)
+chat = Chat(model, image_processor,tokenizer, device=device, fast_preprocess=args.fast_preprocess,
+            session_cache_bytes=int(args.session_cache_gb * (1 << 30)))
 
 
 title = """<h1 align="center">STING BEE Demo</h1>"""